@@ -1,14 +1,21 @@
+import os
+import abc
 import asyncio
 import datetime
-import os
+import hashlib
+import time
 
-import aiofiles
 import aiohttp
-import requests
 
-from PIL import Image
-from sqlmodel import Field, Session, SQLModel, create_engine, select
+import imaging
+import metrics
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import DateTime, Field, Index, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from aiogram import Bot, types
+from aiogram.exceptions import TelegramRetryAfter
 from fake_useragent import UserAgent
 from bs4 import BeautifulSoup
 
@@ -20,6 +27,10 @@ class Site(SQLModel, table=True):
 
 
 class Comic(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_comic_site_id_comic_id_on_site", "site_id", "comic_id_on_site", unique=True),
+    )
+
     id: int = Field(default=None, primary_key=True)
     site_id: int = Field(foreign_key="site.id")
     comic_id_on_site: str
@@ -34,182 +45,482 @@ class Settings(SQLModel, table=True):
     site_id: int = Field(foreign_key="site.id")
     buvid3: str
     user_agent: str
-    created_at: datetime.datetime
+    created_at: datetime.datetime = Field(sa_type=DateTime)
+
 
+db_url = "sqlite+aiosqlite:///comics.db"
+engine = create_async_engine(db_url)
 
-db_url = "sqlite:///comics.db"
-engine = create_engine(db_url)
-SQLModel.metadata.create_all(engine)
 
+@event.listens_for(engine.sync_engine, "connect")
+def configure_sqlite(connection, _):
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
 
-API_TOKEN = "..."
+
+API_TOKEN = os.getenv("API_TOKEN", "...")
 USER_IDS = [...]
 ADMIN_ID = 370247555
 bot = Bot(token=API_TOKEN)
 
+request_timeout = aiohttp.ClientTimeout(total=30, sock_connect=10)
+detail_concurrency = 8
+telegram_rate = 20
+telegram_burst = 5
+telegram_retries = 5
+cover_processing = {'format': 'JPEG', 'quality': 60, 'force': True}
+metrics_port = 9103
+
 
-def fetch_buvid3():
+def create_session():
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=8, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, timeout=request_timeout)
+
+
+async def fetch_buvid3(http, base_url):
     headers = {
         'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
     }
-    response = requests.get('https://manga.bilibili.com/ductape/buvid', headers=headers)
-    response.raise_for_status()
-    return response.json()["data"]["buvid3"]
+    async with http.get(f'{base_url}/ductape/buvid', headers=headers) as response:
+        response.raise_for_status()
+        return (await response.json(content_type=None))["data"]["buvid3"]
+
+
+class SourceAdapter(abc.ABC):
+    name = None
+    url = None
+    interval = 300
+    min_interval = 120
+    max_interval = 1800
+    max_backoff = 3600
+    max_pages = 10
+
+    def __init__(self):
+        self.site = None
+        self.etag = None
+        self.last_modified = None
+        self.pending_etag = None
+        self.pending_last_modified = None
+        self.digest = None
+        self.failures = 0
+        self.next_run = 0
+        self.last_poll = None
+        self.arrival_rate = [3600 / self.interval] * 24
+
+    async def prepare(self, http, site):
+        self.site = site
+
+    async def request_json(self, http, method, url, conditional=False, **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        if conditional and self.etag:
+            headers['If-None-Match'] = self.etag
+        if conditional and self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        async with http.request(method, url, headers=headers, **kwargs) as response:
+            if response.status == 304:
+                return None
+            response.raise_for_status()
+            if conditional:
+                self.pending_etag = response.headers.get('ETag')
+                self.pending_last_modified = response.headers.get('Last-Modified')
+            return await response.json(content_type=None)
+
+    @abc.abstractmethod
+    async def fetch_page(self, http, page):
+        pass
+
+    @abc.abstractmethod
+    def comic_id(self, data):
+        pass
+
+    @abc.abstractmethod
+    def to_comic_data(self, data, details):
+        pass
+
+    async def fetch_details(self, http, comic_ids):
+        return {}
+
+    def record_arrivals(self, count):
+        now = time.monotonic()
+        if self.last_poll is not None:
+            hours = max(now - self.last_poll, 60) / 3600
+            hour = datetime.datetime.now().hour
+            self.arrival_rate[hour] = 0.7 * self.arrival_rate[hour] + 0.3 * count / hours
+        self.last_poll = now
+
+    def adaptive_interval(self):
+        rate = self.arrival_rate[datetime.datetime.now().hour]
+        if rate <= 0:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, 3600 / rate))
+
+    def schedule(self, succeeded):
+        if succeeded:
+            self.failures = 0
+            delay = self.adaptive_interval()
+        else:
+            self.failures += 1
+            delay = min(self.max_backoff, self.interval * 2 ** self.failures)
+        self.next_run = time.monotonic() + delay
+        return delay
+
+
+class BilibiliAdapter(SourceAdapter):
+    name = "Bilibili"
+    url = "https://manga.bilibili.com"
+
+    def __init__(self):
+        super().__init__()
+        self.settings = None
+
+    async def prepare(self, http, site):
+        if self.settings is None:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                self.settings = (await session.exec(select(Settings).where(Settings.site_id == site.id))).first()
+
+        if self.settings is None or (datetime.datetime.now() - self.settings.created_at).days >= 20:
+            buvid3 = await fetch_buvid3(http, self.url)
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                settings = self.settings or Settings(site_id=site.id, user_agent=str(UserAgent().chrome))
+                session.add(settings)
+                settings.buvid3 = buvid3
+                settings.created_at = datetime.datetime.now()
+                await session.commit()
+            self.settings = settings
+        await super().prepare(http, site)
+
+    async def fetch_page(self, http, page):
+        headers = {
+            'cookie': f'buvid3={self.settings.buvid3};',
+            'user-agent': self.settings.user_agent,
+        }
+        json_data = {
+            'style_id': -1,
+            'area_id': -1,
+            'is_finish': -1,
+            'order': 3,
+            'special_tag': 0,
+            'page_num': page,
+            'page_size': 30,
+            'is_free': -1,
+        }
+        data = await self.request_json(
+            http, 'POST', f'{self.url}/twirp/comic.v1.Comic/ClassPage',
+            conditional=page == 1, headers=headers, json=json_data
+        )
+        return None if data is None else data.get("data", [])
+
+    def comic_id(self, data):
+        return str(data["season_id"])
+
+    def to_comic_data(self, data, details):
+        return {
+            "comic_id_on_site": self.comic_id(data),
+            "name": data["title"].strip(),
+            "description": data["evaluate"].strip(),
+            "url": f'{self.url}/detail/mc{data["season_id"]}',
+            "cover": data["vertical_cover"]
+        }
+
+
+class KuaikanAdapter(SourceAdapter):
+    name = "Kuaikan"
+    url = "https://www.kuaikanmanhua.com"
+
+    async def fetch_page(self, http, page):
+        data = await self.request_json(
+            http, 'GET',
+            f'{self.url}/search/mini/topic/multi_filter?page={page}&size=48&tag_id=0&update_status=1&pay_status=0&label_dimension_origin=1&sort=3',
+            conditional=page == 1
+        )
+        return None if data is None else data.get("hits", {}).get("topicMessageList", [])
+
+    def comic_id(self, data):
+        return str(data["topic_id"])
+
+    def to_comic_data(self, data, details):
+        return {
+            "comic_id_on_site": self.comic_id(data),
+            "name": data["title"].strip(),
+            "description": details.strip(),
+            "url": f'{self.url}/web/topic/{data["topic_id"]}/',
+            "cover": data["vertical_image_url"]
+        }
+
+    async def fetch_description(self, http, comic_id):
+        async with http.get(f'{self.url}/web/topic/{comic_id}/') as response:
+            response.raise_for_status()
+            html = await response.text()
+        soup = BeautifulSoup(html, 'html.parser')
+        details_box = soup.find('div', class_="detailsBox")
+        description = details_box.find('p').text if details_box else "No description."
+        return description
+
+    async def fetch_details(self, http, comic_ids):
+        semaphore = asyncio.Semaphore(detail_concurrency)
+
+        async def fetch(comic_id):
+            async with semaphore:
+                try:
+                    return await self.fetch_description(http, comic_id)
+                except Exception as e:
+                    print(f"Не удалось получить описание {comic_id}: {e}")
+                    return "No description."
+
+        return dict(zip(comic_ids, await asyncio.gather(*[fetch(comic_id) for comic_id in comic_ids])))
+
+
+adapters = [BilibiliAdapter(), KuaikanAdapter()]
+
+
+async def find_new_ids(session, site_id, comic_ids):
+    known = set((await session.exec(
+        select(Comic.comic_id_on_site).where(Comic.site_id == site_id, Comic.comic_id_on_site.in_(comic_ids))
+    )).all())
+    return [comic_id for comic_id in dict.fromkeys(comic_ids) if comic_id not in known]
+
+
+async def has_comics(session, site_id):
+    return (await session.exec(select(Comic.id).where(Comic.site_id == site_id).limit(1))).first() is not None
+
+
+async def save_comics(session, site_id, comics_data):
+    comics = [
+        Comic(
+            site_id=site_id,
+            comic_id_on_site=comic_data["comic_id_on_site"],
+            name=comic_data["name"],
+            description=comic_data["description"],
+            url=comic_data["url"],
+            cover=comic_data["cover"]
+        )
+        for comic_data in comics_data
+    ]
+    if comics:
+        session.add_all(comics)
+        await session.flush()
+    return comics
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+telegram_limiter = TokenBucket(telegram_rate, telegram_burst)
+
+
+async def send_with_retry(send, **kwargs):
+    for attempt in range(telegram_retries):
+        await telegram_limiter.acquire()
+        try:
+            with metrics.timed_stage('upload'):
+                result = await send(**kwargs)
+            metrics.inc('telegram_requests_total', result='ok')
+            return result
+        except TelegramRetryAfter as e:
+            print(f"Telegram просит подождать {e.retry_after} с")
+            metrics.inc('telegram_requests_total', result='retry_after')
+            telegram_limiter.pause(e.retry_after)
+    await telegram_limiter.acquire()
+    with metrics.timed_stage('upload'):
+        return await send(**kwargs)
+
+
+async def broadcast(send, recipients, **kwargs):
+    async def deliver(chat_id):
+        try:
+            await send_with_retry(send, chat_id=chat_id, **kwargs)
+        except Exception as e:
+            print(f"Не удалось отправить сообщение {chat_id}: {e}")
+
+    await asyncio.gather(*[deliver(chat_id) for chat_id in recipients])
+
+
+async def broadcast_document(data, filename, caption):
+    document = types.BufferedInputFile(data, filename=filename)
+    recipients = list(USER_IDS)
+    while recipients:
+        chat_id = recipients.pop(0)
+        try:
+            sent = await send_with_retry(bot.send_document, chat_id=chat_id, document=document, caption=caption)
+            document = sent.document.file_id
+            break
+        except Exception as e:
+            print(f"Не удалось отправить обложку {chat_id}: {e}")
+
+    await broadcast(bot.send_document, recipients, document=document, caption=caption)
+
+
+async def send_comic_to_telegram(http, comic):
+    try:
+        async with http.get(comic.cover) as response:
+            cover = await response.read() if response.status == 200 else None
+
+        if cover is not None:
+            cover = (await imaging.process(cover, **cover_processing))[0]
+            caption = f"{comic.name}\n{comic.url}\n{comic.description}"
+            await broadcast_document(cover, f'{comic.comic_id_on_site}.jpg', caption[:1024])
+        else:
+            print(f"Не удалось скачать изображение: {comic.cover}")
+            message = f"Без обложки\n{comic.name}\n{comic.url}\n{comic.description}"
+            await broadcast(bot.send_message, USER_IDS, text=message)
+    except Exception as e:
+        print(f"Ошибка при отправке комикса в Telegram: {e}")
 
 
-def fetch_comics_bilibili(settings):
-    headers = {
-        'cookie': f'buvid3={settings.buvid3};',
-        'user-agent': settings.user_agent,
-    }
-    json_data = {
-        'style_id': -1,
-        'area_id': -1,
-        'is_finish': -1,
-        'order': 3,
-        'special_tag': 0,
-        'page_num': 1,
-        'page_size': 30,
-        'is_free': -1,
-    }
-    response = requests.post('https://manga.bilibili.com/twirp/comic.v1.Comic/ClassPage', headers=headers, json=json_data)
-    response.raise_for_status()
-    return response.json().get("data", [])
+def create_schema(connection):
+    SQLModel.metadata.create_all(connection)
+    for index in Comic.__table__.indexes:
+        index.create(connection, checkfirst=True)
 
 
-def fetch_comics_kuaikan():
-    response = requests.get(
-        'https://www.kuaikanmanhua.com/search/mini/topic/multi_filter?page=1&size=48&tag_id=0&update_status=1&pay_status=0&label_dimension_origin=1&sort=3'
-    )
-    response.raise_for_status()
-    return response.json().get("hits", {}).get("topicMessageList", [])
-
-def fetch_kuaikan_description(comic_id):
-    response = requests.get(f'https://www.kuaikanmanhua.com/web/topic/{comic_id}/')
-    response.raise_for_status()
-    soup = BeautifulSoup(response.text, 'html.parser')
-    details_box = soup.find('div', class_="detailsBox")
-    description = details_box.find('p').text if details_box else "No description."
-    return description
-
-def save_comic(session, site_id, comic_data):
-    comic = Comic(
-        site_id=site_id,
-        comic_id_on_site=comic_data["comic_id_on_site"],
-        name=comic_data["name"],
-        description=comic_data["description"],
-        url=comic_data["url"],
-        cover=comic_data["cover"]
-    )
-    session.add(comic)
-    session.commit()
-    return comic
+async def initialize_database():
+    async with engine.begin() as connection:
+        await connection.run_sync(create_schema)
 
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        sites = {site.name: site for site in (await session.exec(select(Site))).all()}
+        missing = [Site(name=adapter.name, url=adapter.url) for adapter in adapters if adapter.name not in sites]
+        if missing:
+            session.add_all(missing)
+            await session.commit()
+            sites.update((site.name, site) for site in missing)
+    return sites
 
-async def send_comic_to_telegram(comic):
+
+async def notify_admin(text):
+    try:
+        await bot.send_message(ADMIN_ID, text)
+    except Exception as send_error:
+        print(f"Failed to send error message: {str(send_error)}")
+
+
+async def collect_new_comics(http, adapter, session):
+    listing = await adapter.fetch_page(http, 1)
+    if listing is None:
+        print(f"{adapter.name}: список не изменился (304)")
+        return {}, [], adapter.digest
+
+    page_ids = [adapter.comic_id(data) for data in listing]
+    digest = hashlib.sha1("\n".join(page_ids).encode()).hexdigest()
+    if digest == adapter.digest:
+        print(f"{adapter.name}: список не изменился")
+        return {}, [], digest
+
+    max_pages = adapter.max_pages
+    if not await has_comics(session, adapter.site.id):
+        max_pages = 1
+        print(f"{adapter.name}: в базе ещё нет комиксов, беру только первую страницу")
+
+    comics = {}
+    new_ids = []
+    for page in range(1, max_pages + 1):
+        if page > 1:
+            listing = await adapter.fetch_page(http, page)
+        if not listing:
+            break
+
+        page_comics = {adapter.comic_id(data): data for data in listing}
+        page_new_ids = [comic_id for comic_id in await find_new_ids(session, adapter.site.id, list(page_comics)) if comic_id not in comics]
+        comics.update(page_comics)
+        new_ids.extend(page_new_ids)
+        if not page_new_ids:
+            break
+    else:
+        if max_pages == adapter.max_pages:
+            print(f"{adapter.name}: достигнут лимит в {max_pages} страниц")
+
+    return comics, new_ids, digest
+
+
+async def poll_source(http, adapter, site):
+    started = time.perf_counter()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(comic.cover) as response:
-                if response.status == 200:
-                    if comic.site_id == 1:
-                        cover_path = f'{comic.comic_id_on_site}.{comic.cover.split(".")[-1]}'
-                    if comic.site_id == 2:
-                        cover_path = f'{comic.comic_id_on_site}.jpg'
-                    async with aiofiles.open(f'{cover_path}', 'wb') as out_file:
-                        await out_file.write(await response.read())
-
-                    image = Image.open(cover_path)
-                    if image.mode == 'RGBA':
-                        image = image.convert('RGB')
-                    image.save(cover_path, 'JPEG', quality=60)
-
-                    file = types.FSInputFile(cover_path)
-                    caption = f"{comic.name}\n{comic.url}\n{comic.description}"
-                    for USER_ID in USER_IDS:
-                        await bot.send_document(chat_id=USER_ID, document=file, caption=caption[:1024])
-                    os.remove(cover_path)
-                else:
-                    print(f"Не удалось скачать изображение: {comic.cover}")
-                    message = f"Без обложки\n{comic.name}\n{comic.url}\n{comic.description}"
-                    for USER_ID in USER_IDS:
-                        await bot.send_message(USER_ID, message)
+        await adapter.prepare(http, site)
+
+        async with AsyncSession(engine, expire_on_commit=False) as session, session.begin():
+            with metrics.timed_stage('listing', source=adapter.name):
+                comics, new_ids, digest = await collect_new_comics(http, adapter, session)
+            with metrics.timed_stage('details', source=adapter.name, comics=len(new_ids)):
+                details = await adapter.fetch_details(http, new_ids) if new_ids else {}
+            saved = await save_comics(session, adapter.site.id, [
+                adapter.to_comic_data(comics[comic_id], details.get(comic_id)) for comic_id in new_ids
+            ])
+        for comic in saved:
+            await send_comic_to_telegram(http, comic)
+        adapter.digest = digest
+        adapter.etag, adapter.last_modified = adapter.pending_etag, adapter.pending_last_modified
+        adapter.record_arrivals(len(new_ids))
+        metrics.inc('announcer_new_comics_total', len(new_ids), source=adapter.name)
+        delay = adapter.schedule(True)
+        status = 'ok'
     except Exception as e:
-        if os.path.exists(cover_path):
-            os.remove(cover_path)
-        print(f"Ошибка при отправке комикса в Telegram: {e}")
+        delay = adapter.schedule(False)
+        status = 'error'
+        print(f"Error ({adapter.name}): {str(e)}")
+        await notify_admin(f"Error ({adapter.name}): {str(e)}")
+    seconds = time.perf_counter() - started
+    metrics.observe('announcer_poll_seconds', seconds, source=adapter.name)
+    metrics.inc('announcer_polls_total', source=adapter.name, result=status)
+    metrics.set_gauge('announcer_next_poll_seconds', delay, source=adapter.name)
+    metrics.log('poll', source=adapter.name, status=status, seconds=round(seconds, 3), next_poll=round(delay))
+    print(f'{adapter.name}: следующая проверка через {delay / 60:.0f} мин. Сейчас:', f'{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
 
-def initialize_database():
-    with Session(engine) as session:
-        if not session.exec(select(Site)).first():
-            bilibili = Site(name="Bilibili", url="https://manga.bilibili.com")
-            kuaikan = Site(name="Kuaikan", url="https://www.kuaikanmanhua.com")
-            session.add_all([bilibili, kuaikan])
-            session.commit()
-
-            user_agent = str(UserAgent().chrome)
-            buvid3 = fetch_buvid3()
-            bilibili_settings = Settings(site_id=bilibili.id, buvid3=buvid3, user_agent=user_agent, created_at=datetime.datetime.now())
-            session.add(bilibili_settings)
-            session.commit()
-
-async def process_comics():
-    with Session(engine) as session:
-        bilibili_site = session.exec(select(Site).where(Site.name == "Bilibili")).first()
-        kuaikan_site = session.exec(select(Site).where(Site.name == "Kuaikan")).first()
-        settings = session.exec(select(Settings).where(Settings.site_id == bilibili_site.id)).first()
-        if (datetime.datetime.now() - settings.created_at).days >= 20:
-            settings.buvid3 = fetch_buvid3()
-            settings.created_at = datetime.datetime.now()
-            session.commit()
-
-        while True:
-            try:
-                bilibili_comics = fetch_comics_bilibili(settings)
-                for data in bilibili_comics:
-                    if not session.exec(select(Comic).where(Comic.comic_id_on_site == str(data["season_id"]))).first():
-                        comic_data = {
-                            "comic_id_on_site": str(data["season_id"]),
-                            "name": data["title"].strip(),
-                            "description": data["evaluate"].strip(),
-                            "url": f'https://manga.bilibili.com/detail/mc{data["season_id"]}',
-                            "cover": data["vertical_cover"]
-                        }
-                        comic = save_comic(session, bilibili_site.id, comic_data)
-                        await send_comic_to_telegram(comic)
-
-                kuaikan_comics = fetch_comics_kuaikan()
-                for data in kuaikan_comics:
-                    if not session.exec(select(Comic).where(Comic.comic_id_on_site == str(data["topic_id"]))).first():
-                        description = fetch_kuaikan_description(data["topic_id"])
-                        comic_data = {
-                            "comic_id_on_site": str(data["topic_id"]),
-                            "name": data["title"].strip(),
-                            "description": description.strip(),
-                            "url": f'https://www.kuaikanmanhua.com/web/topic/{data["topic_id"]}/',
-                            "cover": data["vertical_image_url"]
-                        }
-                        comic = save_comic(session, kuaikan_site.id, comic_data)
-                        await send_comic_to_telegram(comic)
-
-                print('Ухожу поспать 5 минут. Сейчас:', f'{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
-                await asyncio.sleep(300)
-
-            except Exception as e:
-                print(f"Error: {str(e)}")
-                try:
-                    await bot.send_message(ADMIN_ID, f"Error: {str(e)}")
-                except Exception as send_error:
-                    print(f"Failed to send error message: {str(send_error)}")
-            finally:
-                for img in os.listdir():
-                    if img.endswith(".jpg") or img.endswith(".jpeg") or img.endswith(".png"):
-                        os.remove(img)
+async def watch_source(http, adapter, site):
+    while True:
+        await poll_source(http, adapter, site)
+        await asyncio.sleep(max(1, adapter.next_run - time.monotonic()))
+
+
+async def process_comics(http, sites):
+    await asyncio.gather(*[watch_source(http, adapter, sites[adapter.name]) for adapter in adapters])
+
+
+async def run():
+    sites = await initialize_database()
+    await metrics.start('announcer', metrics_port)
+    try:
+        async with create_session() as http:
+            await process_comics(http, sites)
+    finally:
+        await metrics.stop()
+        await engine.dispose()
 
 
 def main():
-    initialize_database()
-    asyncio.run(process_comics())
+    try:
+        asyncio.run(run())
+    finally:
+        imaging.shutdown()
 
 
 if __name__ == "__main__":
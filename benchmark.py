@@ -0,0 +1,590 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import resource
+import importlib
+import tempfile
+
+from aiohttp import web
+from PIL import Image
+
+
+host = '127.0.0.1'
+fake_token = '123456:benchmark'
+targets = ['iqtao', 'dumanwu', 'announcer']
+sites = {'iqtao': 'iqtao.cn', 'dumanwu': 'dumanwu.com'}
+page_modes = ['data-src', 'script', 'lazy']
+
+chapter_count = 4
+page_count = 30
+image_size = 200
+image_width = 800
+page_ratio = 1.5
+banner_ratio = 0.15
+latency = 20
+error_rate = 0.02
+break_rate = 0.02
+telegram_latency = 50
+listing_size = 30
+new_per_cycle = 5
+announcer_cycles = 3
+subscriber_count = 2
+child_timeout = 900
+
+
+def make_image(size, width=image_width, ratio=page_ratio):
+    noise = 16
+    while True:
+        image = Image.new('RGB', (width, max(int(width * ratio), noise)), 'white')
+        image.paste(Image.frombytes('RGB', (width, noise), os.urandom(width * noise * 3)))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        if buffer.tell() >= size or noise >= 20000:
+            return buffer.getvalue()
+        noise = max(noise + 16, int(noise * size / buffer.tell()) + 16)
+
+
+class FakeSite:
+    def __init__(self, options):
+        self.options = options
+        self.image = make_image(options.image_size * 1024)
+        self.cover = make_image(20 * 1024, 300)
+        self.banner = make_image(8 * 1024, image_width, banner_ratio)
+        self.base = None
+        self.released = 0
+        self.stats = {'pages': 0, 'images': 0, 'bytes': 0, 'errors': 0, 'breaks': 0, 'ranges': 0, 'probes': 0}
+        self.telegram = {'requests': 0, 'documents': 0, 'uploaded': 0}
+
+    def app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get('/iqtao/', self.series_index)
+        app.router.add_get('/dumanwu/', self.series_index)
+        app.router.add_get('/iqtao/{chapter}.html', self.iqtao_chapter)
+        app.router.add_get('/dumanwu/{chapter}.html', self.dumanwu_chapter)
+        app.router.add_get('/img/{chapter}/{page}.jpg', self.page_image)
+        app.router.add_get('/images/{name}', self.placeholder)
+        app.router.add_get('/static/images/banner.png', self.banner_image)
+        app.router.add_get('/static/images/{name}', self.placeholder)
+        app.router.add_get('/cover/{name}', self.cover_image)
+        app.router.add_get('/bilibili/ductape/buvid', self.buvid)
+        app.router.add_post('/bilibili/twirp/comic.v1.Comic/ClassPage', self.bilibili_listing)
+        app.router.add_get('/kuaikan/search/mini/topic/multi_filter', self.kuaikan_listing)
+        app.router.add_get('/kuaikan/web/topic/{topic_id}/', self.kuaikan_topic)
+        app.router.add_post('/control/release', self.release)
+        app.router.add_post('/bot{token}/{method}', self.telegram_method)
+        return app
+
+    def snapshot(self):
+        return {**self.stats, **{f'telegram_{key}': value for key, value in self.telegram.items()}}
+
+    async def delay(self):
+        await asyncio.sleep(self.options.latency / 1000)
+
+    def page_links(self, chapter):
+        return [f'/img/{chapter}/{idx}.jpg' for idx in range(self.options.pages)]
+
+    def page_images(self, chapter, placeholder):
+        links = self.page_links(chapter)
+        if self.options.mode == 'data-src':
+            return ''.join(f'<img src="{placeholder}" data-src="{link}">' for link in links)
+        if self.options.mode == 'script':
+            absolute = json.dumps([f'{self.base}{link}' for link in links]).replace('/', '\\/')
+            return f'<script>var chapterImages = {absolute};</script>'
+
+        encoded = base64.b64encode(json.dumps(links).encode()).decode()
+        images = ''.join(f'<img class="page" src="{placeholder}" style="display:block;height:1200px">' for _ in links)
+        return images + f"""<script>
+const pages = JSON.parse(atob('{encoded}'));
+const reveal = () => document.querySelectorAll('img.page').forEach((img, idx) => {{
+    if (!img.dataset.loaded && img.getBoundingClientRect().top < window.innerHeight * 2) {{
+        img.dataset.loaded = '1';
+        setTimeout(() => img.src = pages[idx], 50);
+    }}
+}});
+window.addEventListener('scroll', reveal);
+setTimeout(reveal, 200);
+</script>"""
+
+    async def series_index(self, request):
+        await self.delay()
+        links = ''.join(
+            f'<li><a href="{idx}.html">Глава {idx}</a></li>'
+            for idx in range(self.options.chapters, 0, -1)
+        )
+        body = f'<html><body><a href="/">Главная</a><ul class="chapters">{links}</ul></body></html>'
+        return web.Response(text=body, content_type='text/html')
+
+    async def iqtao_chapter(self, request):
+        await self.delay()
+        self.stats['pages'] += 1
+        chapter = request.match_info['chapter']
+        body = (
+            f'<html><head><title>{chapter}</title></head><body><h1>Глава {chapter}</h1>'
+            f'<img src="/images/floatW.png">{self.page_images(chapter, "/images/loading_bak.png")}</body></html>'
+        )
+        return web.Response(text=body, content_type='text/html')
+
+    async def dumanwu_chapter(self, request):
+        await self.delay()
+        self.stats['pages'] += 1
+        chapter = request.match_info['chapter']
+        images = self.page_images(chapter, '/static/images/load.gif')
+        if self.options.mode != 'script':
+            images = f'<div class="main_img"><img src="/static/images/banner.png">{images}</div>'
+        body = f'<html><head><title>Глава {chapter}漫画 - 读漫屋</title></head><body>{images}</body></html>'
+        return web.Response(text=body, content_type='text/html')
+
+    async def placeholder(self, request):
+        return web.Response(body=self.cover[:256], content_type='image/png')
+
+    async def banner_image(self, request):
+        return web.Response(body=self.banner, content_type='image/jpeg')
+
+    async def page_image(self, request):
+        await self.delay()
+        if random.random() < self.options.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=503)
+
+        page_id = f"{request.match_info['chapter']}/{request.match_info['page']}".encode()
+        body = self.image[:2] + b'\xff\xfe' + (len(page_id) + 2).to_bytes(2, 'big') + page_id + self.image[2:]
+        start, end = 0, len(body) - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if match and int(match[1]) < len(body):
+            start = int(match[1])
+            end = min(end, int(match[2])) if match[2] else end
+            self.stats['probes' if match[2] else 'ranges'] += 1
+        partial = match is not None and (start or end < len(body) - 1)
+
+        headers = {'Content-Type': 'image/jpeg', 'Content-Length': str(end + 1 - start), 'Accept-Ranges': 'bytes'}
+        if partial:
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(body)}'
+        response = web.StreamResponse(status=206 if partial else 200, headers=headers)
+        await response.prepare(request)
+
+        if not partial and random.random() < self.options.break_rate:
+            self.stats['breaks'] += 1
+            await response.write(body[:len(body) // 2])
+            request.transport.close()
+            return response
+
+        await response.write(body[start:end + 1])
+        await response.write_eof()
+        if not match or not match[2]:
+            self.stats['images'] += 1
+        self.stats['bytes'] += end + 1 - start
+        return response
+
+    async def cover_image(self, request):
+        await self.delay()
+        return web.Response(body=self.cover, content_type='image/jpeg')
+
+    def catalog(self, page, size):
+        total = self.options.listing + self.released
+        return list(range(total - 1, -1, -1))[(page - 1) * size:page * size]
+
+    def listing_etag(self):
+        return f'"{self.options.listing + self.released}"'
+
+    async def buvid(self, request):
+        return web.json_response({'data': {'buvid3': 'benchmark'}})
+
+    async def bilibili_listing(self, request):
+        await self.delay()
+        if request.headers.get('If-None-Match') == self.listing_etag():
+            return web.Response(status=304)
+
+        query = await request.json()
+        data = [
+            {
+                'season_id': 100000 + idx,
+                'title': f'Комикс {idx}',
+                'evaluate': f'Описание комикса {idx}',
+                'vertical_cover': f'{self.base}/cover/b{idx}.jpg',
+            }
+            for idx in self.catalog(query['page_num'], query['page_size'])
+        ]
+        return web.json_response({'code': 0, 'data': data}, headers={'ETag': self.listing_etag()})
+
+    async def kuaikan_listing(self, request):
+        await self.delay()
+        if request.headers.get('If-None-Match') == self.listing_etag():
+            return web.Response(status=304)
+
+        topics = [
+            {
+                'topic_id': 200000 + idx,
+                'title': f'Топик {idx}',
+                'vertical_image_url': f'{self.base}/cover/k{idx}.jpg',
+            }
+            for idx in self.catalog(int(request.query['page']), int(request.query['size']))
+        ]
+        return web.json_response({'hits': {'topicMessageList': topics}}, headers={'ETag': self.listing_etag()})
+
+    async def kuaikan_topic(self, request):
+        await self.delay()
+        topic_id = request.match_info['topic_id']
+        body = f'<html><body><div class="detailsBox"><p>Описание топика {topic_id}</p></div></body></html>'
+        return web.Response(text=body, content_type='text/html')
+
+    async def release(self, request):
+        self.released += int(request.query['count'])
+        return web.json_response({'released': self.released})
+
+    async def telegram_method(self, request):
+        method = request.match_info['method'].lower()
+        body = await request.read()
+        await asyncio.sleep(self.options.telegram_latency / 1000)
+
+        self.telegram['requests'] += 1
+        self.telegram['uploaded'] += len(body)
+        message = {
+            'message_id': self.telegram['requests'],
+            'date': int(time.time()),
+            'chat': {'id': 1, 'type': 'private'},
+        }
+        if method == 'senddocument':
+            self.telegram['documents'] += 1
+            message['document'] = {'file_id': f'file{message["message_id"]}', 'file_unique_id': f'unique{message["message_id"]}'}
+        return web.json_response({'ok': True, 'result': message})
+
+
+class Stages:
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        if asyncio.iscoroutinefunction(original):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+
+        setattr(owner, name, timed)
+
+    def report(self):
+        return {
+            stage: {'count': self.counts[stage], 'total': total, 'mean': total / self.counts[stage]}
+            for stage, total in self.totals.items()
+        }
+
+
+def telegram_bot(base):
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    return Bot(token=fake_token, session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+
+
+def peak_rss():
+    return {
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+async def wait_for_jobs(module, timeout):
+    deadline = time.monotonic() + timeout
+    while module.job_store.pending():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Главы не скачались за отведённое время")
+        await asyncio.sleep(0.05)
+
+
+async def run_bot(name, options):
+    os.environ['TOKEN'] = fake_token
+    module = importlib.import_module(name)
+    module.bot = module.job_store.bot = telegram_bot(options['base'])
+    module.probe_rules[host] = module.probe_rules.get(sites[name], {})
+
+    stages = Stages()
+    stages.wrap(module, 'collect_pages', 'extract')
+    stages.wrap(module.chapters, 'probe_pages', 'probe')
+    stages.wrap(module, 'download_image' if name == 'iqtao' else 'fetch_page', 'fetch')
+    stages.wrap(module.imaging, 'process_file', 'process')
+    stages.wrap(module.chapters.ChapterArchive, 'add', 'archive')
+    stages.wrap(module.chapters.Job, 'answer_document', 'upload')
+
+    delivered = []
+    deliver = module.pipeline.deliver
+
+    async def tracked_deliver(job):
+        delivered.append(job.series_index)
+        await deliver(job)
+
+    module.pipeline.deliver = tracked_deliver
+
+    documents = []
+    answer_document = module.chapters.Job.answer_document
+
+    async def tracked_answer_document(job, document, caption=None):
+        sent = await answer_document(job, document, caption=caption)
+        documents.append(time.perf_counter())
+        return sent
+
+    module.chapters.Job.answer_document = tracked_answer_document
+    if options['volume_size']:
+        module.archive_volume_bytes = options['volume_size'] * 1024
+
+    index = f"{options['base']}/{name}/"
+    if name == 'iqtao':
+        chapters = await module.fetch_series(index)
+    else:
+        async with module.create_session() as session:
+            chapters = await module.fetch_series(session, index)
+    for series_index, (link, title) in enumerate(module.chapters.select_chapters(chapters, f"1-{options['chapters']}")):
+        folder_name = title if name == 'iqtao' else None
+        user_id = series_index % 3 + 1
+        job_id = module.job_store.add(link, folder_name, user_id, user_id, 'benchmark', series_index)
+        job = module.chapters.Job(module.job_store, job_id, link, folder_name, user_id, user_id, series='benchmark', series_index=series_index)
+        module.pipeline.queue.put(job)
+
+    started = time.perf_counter()
+    if name == 'iqtao':
+        if options['mode'] == 'lazy':
+            await module.driver_pool.start()
+        workers = module.start_workers()
+        try:
+            await wait_for_jobs(module, options['timeout'])
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await module.driver_pool.close()
+    else:
+        async with module.create_session() as session:
+            workers = module.start_workers(session)
+            try:
+                await wait_for_jobs(module, options['timeout'])
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    await module.bot.session.close()
+    module.imaging.shutdown()
+    jobs = {
+        dict(labels)['result']: count
+        for (metric, labels), count in module.metrics.counters.items() if metric == 'jobs_total'
+    }
+    ordered = delivered == sorted(delivered)
+    first_document = min(documents) - started if documents else None
+    return {
+        'elapsed': elapsed, 'jobs': jobs, 'ordered': ordered, 'documents': len(documents),
+        'first_document': first_document, 'stages': stages.report(), **peak_rss(),
+    }
+
+
+async def release_comics(http, base, count):
+    async with http.post(f'{base}/control/release', params={'count': count}) as response:
+        response.raise_for_status()
+
+
+async def run_announcer(options):
+    os.environ['API_TOKEN'] = fake_token
+    announcer = importlib.import_module('announcer')
+
+    announcer.bot = telegram_bot(options['base'])
+    announcer.USER_IDS = list(range(1, options['subscribers'] + 1))
+    announcer.adapters[0].url = f"{options['base']}/bilibili"
+    announcer.adapters[1].url = f"{options['base']}/kuaikan"
+
+    stages = Stages()
+    stages.wrap(announcer, 'collect_new_comics', 'listing')
+    stages.wrap(announcer.KuaikanAdapter, 'fetch_details', 'details')
+    stages.wrap(announcer, 'save_comics', 'save')
+    stages.wrap(announcer, 'send_comic_to_telegram', 'notify')
+
+    sites = await announcer.initialize_database()
+    cycles = []
+    async with announcer.create_session() as http:
+        plan = [('cold', 0)] + [('new', options['new'])] * options['cycles'] + [('idle', 0)]
+        for kind, count in plan:
+            if count:
+                await release_comics(http, options['base'], count)
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                announcer.poll_source(http, adapter, sites[adapter.name])
+                for adapter in announcer.adapters
+            ])
+            cycles.append({'kind': kind, 'released': count, 'elapsed': time.perf_counter() - started})
+
+    await announcer.engine.dispose()
+    await announcer.bot.session.close()
+    announcer.imaging.shutdown()
+    return {'elapsed': sum(cycle['elapsed'] for cycle in cycles), 'cycles': cycles, 'stages': stages.report(), **peak_rss()}
+
+
+def run_child(target, options, result_path):
+    random.seed(options['seed'])
+    with tempfile.TemporaryDirectory(prefix=f'bench_{target}_') as workdir:
+        os.chdir(workdir)
+        if target == 'announcer':
+            result = asyncio.run(run_announcer(options))
+        else:
+            result = asyncio.run(run_bot(target, options))
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+async def spawn(target, options, verbose):
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+        result_path = f.name
+    output = None if verbose else asyncio.subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--child', target,
+        '--child-options', json.dumps(options), '--result', result_path,
+        stdout=output, stderr=output,
+    )
+    try:
+        await asyncio.wait_for(process.wait(), options['timeout'] + 60)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+    try:
+        with open(result_path, encoding='utf-8') as f:
+            return json.load(f) if process.returncode == 0 else {'error': f"код выхода {process.returncode}"}
+    except (OSError, ValueError):
+        return {'error': f"нет результата, код выхода {process.returncode}"}
+    finally:
+        os.remove(result_path)
+
+
+def print_report(results, args):
+    for target, result in results.items():
+        site = result.pop('site')
+        if 'error' in result:
+            print(f"{target}: ошибка — {result['error']}")
+            continue
+
+        if target == 'announcer':
+            by_kind = {}
+            for cycle in result['cycles']:
+                by_kind.setdefault(cycle['kind'], []).append(cycle['elapsed'])
+            summary = ', '.join(f"{kind} {sum(times) / len(times):.2f} с" for kind, times in by_kind.items())
+            print(f"{target}: циклы опроса — {summary}")
+        else:
+            pages = args.chapters * args.pages
+            elapsed = result['elapsed']
+            jobs = ', '.join(f"{outcome} {count}" for outcome, count in sorted(result['jobs'].items()))
+            print(
+                f"{target}: {args.chapters} глав, {pages} стр. за {elapsed:.2f} с — "
+                f"{args.chapters / elapsed:.2f} глав/с, {pages / elapsed:.1f} стр/с, "
+                f"{site['bytes'] / elapsed / 1024 ** 2:.1f} МБ/с; задания: {jobs}; "
+                f"порядок {'сохранён' if result['ordered'] else 'нарушен'}"
+            )
+            if result['first_document'] is not None:
+                print(f"  архивов {result['documents']}, первый через {result['first_document']:.2f} с")
+
+        for stage, timing in result['stages'].items():
+            print(f"  {stage:<8} {timing['count']:>5} × {timing['mean'] * 1000:8.1f} мс = {timing['total']:7.2f} с")
+        print(
+            f"  пик RSS {result['rss_mb']:.0f} МБ (дочерние {result['children_rss_mb']:.0f} МБ); "
+            f"сайт: ошибок {site['errors']}, обрывов {site['breaks']}, докачек {site['ranges']}, проверок {site['probes']}; "
+            f"telegram: {site['telegram_requests']} запросов, {site['telegram_documents']} документов, "
+            f"{site['telegram_uploaded'] / 1024 ** 2:.1f} МБ"
+        )
+
+
+async def benchmark(args):
+    random.seed(args.seed)
+    site = FakeSite(args)
+    runner = web.AppRunner(site.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, args.port).start()
+    site.base = f"http://{host}:{runner.addresses[0][1]}"
+    print(f"Тестовый сайт запущен на {site.base}")
+
+    options = {
+        'base': site.base,
+        'chapters': args.chapters,
+        'mode': args.mode,
+        'new': args.new,
+        'cycles': args.cycles,
+        'subscribers': args.subscribers,
+        'seed': args.seed,
+        'timeout': args.timeout,
+        'volume_size': args.volume_size,
+    }
+    results = {}
+    try:
+        for target in args.targets:
+            before = site.snapshot()
+            print(f"Запускаю {target}...")
+            results[target] = await spawn(target, options, args.verbose)
+            after = site.snapshot()
+            results[target]['site'] = {key: after[key] - before[key] for key in after}
+    finally:
+        await runner.cleanup()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'options': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+    print_report(results, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк ботов на локальном тестовом сайте")
+    parser.add_argument('targets', nargs='*', help=f"что запускать: {', '.join(targets)} (по умолчанию всё)")
+    parser.add_argument('--chapters', type=int, default=chapter_count, help="глав на бота")
+    parser.add_argument('--pages', type=int, default=page_count, help="страниц в главе")
+    parser.add_argument('--image-size', type=int, default=image_size, help="размер страницы, КБ")
+    parser.add_argument('--mode', choices=page_modes, default='data-src', help="как страница отдаёт ссылки (lazy требует Chrome)")
+    parser.add_argument('--latency', type=int, default=latency, help="задержка ответа сайта, мс")
+    parser.add_argument('--error-rate', type=float, default=error_rate, help="доля ответов 503")
+    parser.add_argument('--break-rate', type=float, default=break_rate, help="доля оборванных загрузок")
+    parser.add_argument('--volume-size', type=int, default=0, help="бюджет одного архива, КБ (0 — как в боте)")
+    parser.add_argument('--telegram-latency', type=int, default=telegram_latency, help="задержка Bot API, мс")
+    parser.add_argument('--listing', type=int, default=listing_size, help="комиксов в каталоге на старте")
+    parser.add_argument('--new', type=int, default=new_per_cycle, help="новинок за цикл анонсера")
+    parser.add_argument('--cycles', type=int, default=announcer_cycles, help="циклов анонсера с новинками")
+    parser.add_argument('--subscribers', type=int, default=subscriber_count, help="получателей анонсов")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--timeout', type=int, default=child_timeout, help="лимит на один прогон, с")
+    parser.add_argument('--json', help="сохранить результаты в файл")
+    parser.add_argument('--verbose', action='store_true', help="показывать вывод ботов")
+    parser.add_argument('--child', choices=targets, help=argparse.SUPPRESS)
+    parser.add_argument('--child-options', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, json.loads(args.child_options), args.result)
+        return
+
+    args.targets = args.targets or targets
+    unknown = [target for target in args.targets if target not in targets]
+    if unknown:
+        parser.error(f"неизвестные цели: {', '.join(unknown)}")
+    asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
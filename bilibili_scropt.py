@@ -1,71 +1,323 @@
+import argparse
 import base64
+import json
 import os
+import queue
+import re
+import shutil
+import threading
 import time
+import urllib.request
+import zipfile
 from selenium import webdriver
-from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.action_chains import ActionChains
 
 
-chrome_options = Options()
-# chrome_options.add_argument('--headless')
-chrome_options.add_argument('--no-sandbox')
-chrome_options.add_argument('--disable-dev-shm-usage')
-chrome_options.add_argument("--disable-web-security")
-driver = webdriver.Chrome(options=chrome_options)
-
+chapter_url = 'https://manga.bilibili.com/mc33601/1250422'
 output_folder = 'images/canvases'
-os.makedirs(output_folder, exist_ok=True)
+batch_output_folder = 'images/bilibili'
+manifest_name = 'manifest.json'
+tab_count = 3
+
+capture_format = 'image/jpeg'
+capture_quality = 0.92
+capture_batch_size = 8
+paint_timeout = 20
+load_timeout = 60
+
+extensions = {'image/jpeg': 'jpg', 'image/webp': 'webp', 'image/png': 'png'}
+
 script = """
 (function() {
     'use strict';
 
     const originalToDataURL = HTMLCanvasElement.prototype.toDataURL;
+    const originalToBlob = HTMLCanvasElement.prototype.toBlob;
 
     Object.defineProperty(HTMLCanvasElement.prototype, 'toDataURL', {
         configurable: false, // Нельзя удалить или переопределить
         writable: false,
         value: originalToDataURL
     });
+    Object.defineProperty(HTMLCanvasElement.prototype, 'toBlob', {
+        configurable: false,
+        writable: false,
+        value: originalToBlob
+    });
 })();
 """
 
-driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
-            "source": """
+capture_script = """
+const [start, batchSize, format, quality, paintTimeout, loadTimeout, skip, done] = arguments;
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+const isPainted = (canvas) => {
+    if (!canvas.width || !canvas.height) return false;
+    const probe = document.createElement('canvas');
+    probe.width = probe.height = 8;
+    const context = probe.getContext('2d');
+    context.drawImage(canvas, 0, 0, 8, 8);
+    const pixels = context.getImageData(0, 0, 8, 8).data;
+    for (let i = 3; i < pixels.length; i += 4) {
+        if (pixels[i] !== 0) return true;
+    }
+    return false;
+};
+
+const waitFor = async (check, timeout) => {
+    const deadline = performance.now() + timeout;
+    while (performance.now() < deadline) {
+        if (check()) return true;
+        await sleep(100);
+    }
+    return check();
+};
+
+const encode = (canvas) => new Promise((resolve) => {
+    canvas.toBlob((blob) => {
+        if (!blob) return resolve('');
+        const reader = new FileReader();
+        reader.onloadend = () => resolve(reader.result.split(',')[1] || '');
+        reader.readAsDataURL(blob);
+    }, format, quality);
+});
+
+(async () => {
+    const started = performance.now();
+    await waitFor(() => document.querySelectorAll('canvas').length > 0, loadTimeout);
+
+    const canvases = Array.from(document.querySelectorAll('canvas'));
+    const batch = canvases.slice(start, start + batchSize);
+    const pages = [];
+    for (const [offset, canvas] of batch.entries()) {
+        if (skip.includes(start + offset)) continue;
+        canvas.scrollIntoView({block: 'center'});
+        let painted = false;
+        try {
+            painted = await waitFor(() => isPainted(canvas), paintTimeout);
+        } catch (e) {}
+        pages.push({
+            index: start + offset,
+            painted: painted,
+            data: painted ? await encode(canvas) : '',
+        });
+    }
+    done({total: canvases.length, pages: pages, elapsed: Math.round(performance.now() - started)});
+})().catch((e) => done({error: String(e), total: 0, pages: []}));
+"""
+
+
+def create_driver(headless=False):
+    chrome_options = Options()
+    if headless:
+        chrome_options.add_argument('--headless')
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument("--disable-web-security")
+    driver = webdriver.Chrome(options=chrome_options)
+
+    driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
+        "source": """
             Object.defineProperty(navigator, 'webdriver', {
               get: () => undefined
             })
-          """
+        """
+    })
+
+    driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": script})
+    return driver
+
+
+def capture_canvases(driver, folder, saved_pages=(), on_page=None):
+    os.makedirs(folder, exist_ok=True)
+    extension = extensions[capture_format]
+    driver.set_script_timeout(load_timeout + capture_batch_size * paint_timeout + 30)
+
+    started = time.monotonic()
+    start = 0
+    saved = 0
+    total = 0
+    while True:
+        result = driver.execute_async_script(
+            capture_script, start, capture_batch_size, capture_format, capture_quality,
+            paint_timeout * 1000, load_timeout * 1000, list(saved_pages)
+        )
+        if result.get('error'):
+            print(f"Ошибка захвата: {result['error']}")
+            break
+
+        total = result['total']
+        for page in result['pages']:
+            if not page['data']:
+                print(f"Пропущена {page['index'] + 1}: холст не отрисовался")
+                continue
+            img_path = os.path.join(folder, f"{page['index']}.{extension}")
+            with open(img_path, 'wb') as f:
+                f.write(base64.b64decode(page['data']))
+            saved += 1
+            if on_page:
+                on_page(page['index'], total)
+            print(f"Скачалась {page['index'] + 1}")
+
+        start += capture_batch_size
+        if start >= total:
+            break
+
+    print(f"Сохранено {saved} страниц за {time.monotonic() - started:.1f} с")
+    return saved, total
+
+
+def fetch_chapters(comic_id):
+    request = urllib.request.Request(
+        'https://manga.bilibili.com/twirp/comic.v1.Comic/ComicDetail?device=pc&platform=web',
+        data=json.dumps({'comic_id': int(comic_id)}).encode(),
+        headers={'Content-Type': 'application/json'},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        data = json.load(response)['data']
+
+    chapters = []
+    for episode in sorted(data['ep_list'], key=lambda ep: ep['ord']):
+        if episode.get('is_locked'):
+            continue
+        chapters.append({
+            'key': f"mc{comic_id}/{episode['id']}",
+            'url': f"https://manga.bilibili.com/mc{comic_id}/{episode['id']}",
+            'name': f"{episode['ord']:g}_{episode['id']}",
         })
+    return chapters
+
+
+def parse_targets(targets):
+    chapters = []
+    for target in targets:
+        match = re.search(r'mc(\d+)/(\d+)', target)
+        if match:
+            chapters.append({
+                'key': f"mc{match[1]}/{match[2]}",
+                'url': f"https://manga.bilibili.com/mc{match[1]}/{match[2]}",
+                'name': match[2],
+            })
+            continue
+
+        match = re.fullmatch(r'(?:mc)?(\d+)', target.strip()) or re.search(r'/detail/mc(\d+)', target)
+        if not match:
+            raise ValueError(f"Не понимаю цель: {target}")
+        chapters.extend(fetch_chapters(match[1]))
+    return chapters
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.chapters = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.chapters = json.load(f)
+
+    def save(self):
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.chapters, f, ensure_ascii=False, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def chapter(self, chapter):
+        with self.lock:
+            return self.chapters.setdefault(chapter['key'], {'url': chapter['url'], 'pages': [], 'total': None, 'done': False})
+
+    def page_saved(self, chapter, index, total):
+        with self.lock:
+            entry = self.chapters[chapter['key']]
+            if index not in entry['pages']:
+                entry['pages'].append(index)
+            entry['total'] = total
+            self.save()
+
+    def finish(self, chapter, total):
+        with self.lock:
+            entry = self.chapters[chapter['key']]
+            entry['total'] = total
+            entry['done'] = bool(total) and len(entry['pages']) >= total
+            self.save()
+            return entry['done']
+
+
+def seal_archive(folder):
+    archive_path = f"{folder}.zip"
+    with zipfile.ZipFile(f"{archive_path}.tmp", 'w', zipfile.ZIP_STORED) as archive:
+        for name in sorted(os.listdir(folder), key=lambda name: int(name.split('.')[0])):
+            archive.write(os.path.join(folder, name), name)
+    os.replace(f"{archive_path}.tmp", archive_path)
+    shutil.rmtree(folder)
+
+
+def capture_worker(chapters, manifest, output, archive, headless):
+    driver = create_driver(headless)
+    try:
+        while True:
+            try:
+                chapter = chapters.get_nowait()
+            except queue.Empty:
+                return
+
+            entry = manifest.chapter(chapter)
+            folder = os.path.join(output, chapter['name'])
+            print(f"Глава {chapter['key']}: уже есть {len(entry['pages'])} страниц")
+            try:
+                driver.get(chapter['url'])
+                _, total = capture_canvases(
+                    driver, folder, entry['pages'],
+                    lambda index, total: manifest.page_saved(chapter, index, total),
+                )
+                if manifest.finish(chapter, total) and archive:
+                    seal_archive(folder)
+            except Exception as e:
+                print(f"Ошибка в главе {chapter['key']}: {e}")
+    finally:
+        driver.quit()
+
+
+def download_batch(chapters, output, tabs, archive, headless):
+    os.makedirs(output, exist_ok=True)
+    manifest = Manifest(os.path.join(output, manifest_name))
 
+    pending = queue.Queue()
+    for chapter in chapters:
+        if manifest.chapter(chapter)['done']:
+            print(f"Глава {chapter['key']} уже скачана, пропускаю")
+            continue
+        pending.put(chapter)
 
-driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": script})
+    workers = [
+        threading.Thread(target=capture_worker, args=(pending, manifest, output, archive, headless))
+        for _ in range(min(tabs, pending.qsize()))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
-driver.get('https://manga.bilibili.com/mc33601/1250422')
 
-time.sleep(10)
+def main():
+    parser = argparse.ArgumentParser(description="Скачивание глав manga.bilibili.com через canvas")
+    parser.add_argument('targets', nargs='*', help="ID комикса (33601, mc33601) или ссылки на главы")
+    parser.add_argument('--tabs', type=int, default=tab_count, help="количество параллельных браузеров")
+    parser.add_argument('--output', default=batch_output_folder, help="папка для глав и манифеста")
+    parser.add_argument('--archive', action='store_true', help="упаковывать готовые главы в zip")
+    parser.add_argument('--headless', action='store_true', help="запускать браузеры без окна")
+    args = parser.parse_args()
 
-canvases = driver.find_elements(By.TAG_NAME, 'canvas')
+    if not args.targets:
+        driver = create_driver(args.headless)
+        try:
+            driver.get(chapter_url)
+            capture_canvases(driver, output_folder)
+        finally:
+            driver.quit()
+        return
 
-base64_images = []
-for _, canvas in enumerate(canvases):
-    time.sleep(2)
-    driver.execute_script("arguments[0].scrollIntoView();", canvas)
-    time.sleep(2)
-    ActionChains(driver).scroll_to_element(canvas).perform()
-    image_base_64 = driver.execute_script("""
-        var canvas = arguments[0];
-        if (canvas.size === 0) return ''
-        let data = canvas.toDataURL();
-        return data;
-    """, canvas)
-    if not image_base_64:
-        continue
-    img_path = os.path.join(output_folder, f'{_}.png')
-    img_data = base64.b64decode(image_base_64.split(',')[1])
-    with open(img_path, 'wb') as f:
-        f.write(img_data)
-    print(f"Скачалась {_ + 1}")
+    download_batch(parse_targets(args.targets), args.output, args.tabs, args.archive, args.headless)
 
 
-driver.quit()
+if __name__ == '__main__':
+    main()
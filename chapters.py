@@ -0,0 +1,860 @@
+import os
+import re
+import json
+import math
+import time
+import shutil
+import asyncio
+import sqlite3
+import hashlib
+import zipfile
+import threading
+import aiohttp
+
+from collections import OrderedDict, deque
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+import imaging
+import metrics
+
+from bs4 import BeautifulSoup
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+probe_bytes = 32 * 1024
+probe_chunk_size = 64 * 1024
+probe_timeout = aiohttp.ClientTimeout(total=15, sock_connect=10)
+
+chapter_link_pattern = re.compile(r'\d+(?:\.html?)?/?$')
+
+
+def normalize_link(link):
+    parts = urlsplit(link.strip())
+    host = (parts.hostname or '').lower().removeprefix('www.')
+    if parts.port:
+        host += f':{parts.port}'
+    path = parts.path.rstrip('/') or '/'
+    query = urlencode(sorted(parse_qsl(parts.query)))
+    return urlunsplit(('https', host, path, query, ''))
+
+
+def format_eta(seconds):
+    minutes = max(1, round(seconds / 60))
+    return f"~{minutes} мин."
+
+
+class HostSlots:
+    def __init__(self, limits):
+        self.limits = limits
+        self.semaphores = {}
+
+    def slot(self, kind, url):
+        key = (kind, urlsplit(url).hostname)
+        if key not in self.semaphores:
+            self.semaphores[key] = asyncio.Semaphore(self.limits[kind])
+        return self.semaphores[key]
+
+
+class ChapterResult:
+    def __init__(self, title, total, missing, dropped=()):
+        self.title = title
+        self.total = total
+        self.missing = missing
+        self.dropped = list(dropped)
+
+    @property
+    def complete(self):
+        return not self.missing
+
+    def describe_missing(self):
+        return ', '.join(str(idx + 1) for idx in self.missing)
+
+    def describe_dropped(self):
+        return ', '.join(str(idx + 1) for idx in self.dropped)
+
+
+class JobStore:
+    def __init__(self, path, bot):
+        self.bot = bot
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "link TEXT NOT NULL, "
+            "folder_name TEXT, "
+            "chat_id INTEGER NOT NULL, "
+            "user_id INTEGER NOT NULL, "
+            "title TEXT, "
+            "urls TEXT, "
+            "pages TEXT NOT NULL DEFAULT '[]', "
+            "archive_size INTEGER NOT NULL DEFAULT 0, "
+            "archive_index BLOB, "
+            "series TEXT, "
+            "series_index INTEGER, "
+            "waiters TEXT NOT NULL DEFAULT '[]', "
+            "volumes TEXT NOT NULL DEFAULT '[]')"
+        )
+        self.db.commit()
+
+    def add(self, link, folder_name, chat_id, user_id, series=None, series_index=None):
+        cursor = self.db.execute(
+            "INSERT INTO jobs (link, folder_name, chat_id, user_id, series, series_index) VALUES (?, ?, ?, ?, ?, ?)",
+            (link, folder_name, chat_id, user_id, series, series_index),
+        )
+        self.db.commit()
+        return cursor.lastrowid
+
+    def create(self, link, folder_name, message, series=None, series_index=None):
+        job_id = self.add(link, folder_name, message.chat.id, message.from_user.id, series, series_index)
+        return Job(
+            self, job_id, link, folder_name, message.chat.id, message.from_user.id,
+            series=series, series_index=series_index,
+        )
+
+    def pending(self):
+        rows = self.db.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return [
+            Job(
+                self, row['id'], row['link'], row['folder_name'], row['chat_id'], row['user_id'],
+                row['title'], json.loads(row['urls']) if row['urls'] else None,
+                json.loads(row['pages']), row['archive_size'], row['archive_index'],
+                row['series'], row['series_index'], json.loads(row['waiters']), json.loads(row['volumes']),
+            )
+            for row in rows
+        ]
+
+    def set_urls(self, job_id, title, urls):
+        self.db.execute("UPDATE jobs SET title = ?, urls = ? WHERE id = ?", (title, json.dumps(urls), job_id))
+        self.db.commit()
+
+    def checkpoint(self, job_id, pages, archive_size, archive_index):
+        self.db.execute(
+            "UPDATE jobs SET pages = ?, archive_size = ?, archive_index = ? WHERE id = ?",
+            (json.dumps(pages), archive_size, archive_index, job_id),
+        )
+        self.db.commit()
+
+    def set_waiters(self, job_id, waiters):
+        self.db.execute("UPDATE jobs SET waiters = ? WHERE id = ?", (json.dumps(waiters), job_id))
+        self.db.commit()
+
+    def set_volumes(self, job_id, volumes):
+        self.db.execute("UPDATE jobs SET volumes = ? WHERE id = ?", (json.dumps(volumes), job_id))
+        self.db.commit()
+
+    def next_in_series(self, series):
+        return self.db.execute("SELECT MIN(series_index) FROM jobs WHERE series = ?", (series,)).fetchone()[0]
+
+    def remove(self, job_id):
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self.db.commit()
+
+
+class Job:
+    def __init__(self, store, id, link, folder_name, chat_id, user_id, title=None, urls=None, pages=(),
+                 archive_size=0, archive_index=None, series=None, series_index=None, waiters=(), volumes=()):
+        self.store = store
+        self.id = id
+        self.link = link
+        self.folder_name = folder_name
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.title = title
+        self.urls = urls
+        self.pages = list(pages)
+        self.archive_size = archive_size
+        self.archive_index = archive_index
+        self.series = series
+        self.series_index = series_index
+        self.waiters = list(waiters)
+        self.volumes = list(volumes)
+        self.uploads = []
+        self.cached = None
+        self.skip_cache = False
+        self.result = None
+        self.error = None
+        self.started = None
+
+    def attach(self, chat_id):
+        if chat_id == self.chat_id or chat_id in self.waiters:
+            return False
+        self.waiters.append(chat_id)
+        self.store.set_waiters(self.id, self.waiters)
+        return True
+
+    async def answer(self, text):
+        for chat_id in self.waiters:
+            try:
+                await self.store.bot.send_message(chat_id, text)
+            except Exception as e:
+                print(f"Не удалось отправить сообщение {chat_id}: {e}")
+        return await self.store.bot.send_message(self.chat_id, text)
+
+    async def answer_document(self, document, caption=None):
+        sent = await self.store.bot.send_document(self.chat_id, document, caption=caption)
+        for chat_id in self.waiters:
+            try:
+                await self.store.bot.send_document(chat_id, sent.document.file_id, caption=caption)
+            except Exception as e:
+                print(f"Не удалось отправить архив {chat_id}: {e}")
+        return sent
+
+
+class FairQueue:
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs = {}
+        self.users = deque()
+        self.available = asyncio.Semaphore(0)
+        self.average_duration = 60
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.jobs.values())
+
+    def put(self, job):
+        job.enqueued = time.monotonic()
+        self.jobs.setdefault(job.user_id, deque()).append(job)
+        if job.user_id not in self.users:
+            self.users.append(job.user_id)
+        self.available.release()
+        metrics.set_gauge('queue_depth', len(self))
+
+    async def get(self):
+        await self.available.acquire()
+        user_id = self.users.popleft()
+        jobs = self.jobs[user_id]
+        job = jobs.popleft()
+        if jobs:
+            self.users.append(user_id)
+        else:
+            del self.jobs[user_id]
+        metrics.set_gauge('queue_depth', len(self))
+        metrics.observe('queue_wait_seconds', time.monotonic() - job.enqueued)
+        return job
+
+    def bump(self, job):
+        jobs = self.jobs.get(job.user_id)
+        if job.series or not jobs or job not in jobs:
+            return False
+        jobs.remove(job)
+        jobs.appendleft(job)
+        self.users.remove(job.user_id)
+        self.users.appendleft(job.user_id)
+        return True
+
+    def position(self, job):
+        jobs = self.jobs.get(job.user_id, ())
+        if job not in jobs:
+            return 0
+
+        index = jobs.index(job)
+        ahead = index
+        before = True
+        for user_id in self.users:
+            if user_id == job.user_id:
+                before = False
+                continue
+            ahead += min(len(self.jobs[user_id]), index + 1 if before else index)
+        return ahead + 1
+
+    def eta(self, job):
+        return math.ceil(self.position(job) / self.workers) * self.average_duration
+
+    def record(self, duration):
+        self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+
+
+class ChapterCache:
+    def __init__(self, path, folder, max_bytes, max_entries):
+        self.path = path
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.entries = OrderedDict(json.load(f))
+        if max_bytes:
+            os.makedirs(folder, exist_ok=True)
+
+    def key(self, link, folder_name):
+        return f"{normalize_link(link)}|{folder_name}"
+
+    def save(self):
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def get(self, link, folder_name):
+        key = self.key(link, folder_name)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, link, folder_name, file_id, filename, caption, archive_path=None, volumes=()):
+        key = self.key(link, folder_name)
+        self.discard_file(self.entries.pop(key, None))
+
+        entry = {'file_id': file_id, 'filename': filename, 'caption': caption, 'path': None, 'size': 0}
+        if volumes:
+            entry['volumes'] = [
+                {'file_id': volume['file_id'], 'filename': volume['filename'], 'caption': volume['caption']}
+                for volume in volumes
+            ]
+        if archive_path and self.max_bytes:
+            path = os.path.join(self.folder, f"{hashlib.sha1(key.encode()).hexdigest()}.zip")
+            os.replace(archive_path, path)
+            entry.update(path=path, size=os.path.getsize(path))
+
+        self.entries[key] = entry
+        self.evict()
+        self.save()
+
+    def invalidate(self, link, folder_name=None):
+        prefix = f"{normalize_link(link)}|"
+        if folder_name is None:
+            keys = [key for key in self.entries if key.startswith(prefix)]
+        else:
+            keys = [key for key in [self.key(link, folder_name)] if key in self.entries]
+        for key in keys:
+            self.discard_file(self.entries.pop(key))
+        self.save()
+        return len(keys)
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.discard_file(self.entries.popitem(last=False)[1])
+
+        total = sum(entry['size'] for entry in self.entries.values())
+        for entry in self.entries.values():
+            if total <= self.max_bytes:
+                break
+            if entry['path']:
+                total -= entry['size']
+                self.discard_file(entry)
+                entry.update(path=None, size=0)
+
+    def discard_file(self, entry):
+        if entry and entry['path'] and os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+
+def volume_path(path, number):
+    if not number:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}_{number}{extension}"
+
+
+def page_size(data):
+    if isinstance(data, bytes):
+        return len(data)
+    if isinstance(data, list):
+        return sum(len(chunk) for chunk in data)
+    position = data.tell()
+    data.seek(0, os.SEEK_END)
+    size = data.tell()
+    data.seek(position)
+    return size
+
+
+class ChapterArchive:
+    def __init__(self, path, extension='jpg', done=(), size=0, index=None, on_checkpoint=None,
+                 volumes=(), volume_bytes=None, on_seal=None, checkpoint_pages=10):
+        self.base = path
+        self.extension = extension
+        self.on_checkpoint = on_checkpoint
+        self.volume_bytes = volume_bytes
+        self.on_seal = on_seal
+        self.checkpoint_pages = checkpoint_pages
+        self.volume = len(volumes)
+        self.path = volume_path(path, self.volume)
+        sealed = {idx for pages in volumes for idx in pages}
+        if done and index and os.path.exists(self.path) and os.path.getsize(self.path) >= size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(size)
+                f.seek(size)
+                f.write(index)
+            self.done = set(done) | sealed
+            self.zip = zipfile.ZipFile(self.path, 'a', zipfile.ZIP_STORED)
+        else:
+            self.done = sealed
+            self.zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED)
+        self.volume_pages = sorted(self.done - sealed)
+        self.pending = {}
+        self.next_idx = 0
+        self.unsaved = 0
+        self.missing = []
+        self.dropped = []
+        self.busy = 0
+        self.lock = threading.Lock()
+
+    def name(self, idx, head, part=None):
+        extension = imaging.image_extension(head) or self.extension
+        return f'{idx}.{extension}' if part is None else f'{idx}_{part}.{extension}'
+
+    def write(self, idx, data):
+        if isinstance(data, bytes):
+            self.zip.writestr(self.name(idx, data), data)
+            return
+        if isinstance(data, list):
+            for part, chunk in enumerate(data):
+                self.zip.writestr(self.name(idx, chunk, None if len(data) == 1 else part), chunk)
+            return
+        head = data.read(16)
+        data.seek(0)
+        with data, self.zip.open(self.name(idx, head), 'w') as entry:
+            shutil.copyfileobj(data, entry)
+
+    def add(self, idx, data):
+        with self.lock:
+            self.pending[idx] = data
+            while self.next_idx in self.pending or self.next_idx in self.done:
+                data = self.pending.pop(self.next_idx, None)
+                if data is not None:
+                    started = time.perf_counter()
+                    if self.is_full(data):
+                        self.seal()
+                    self.write(self.next_idx, data)
+                    self.busy += time.perf_counter() - started
+                    self.done.add(self.next_idx)
+                    self.volume_pages.append(self.next_idx)
+                    self.unsaved += 1
+                self.next_idx += 1
+            if self.unsaved >= self.checkpoint_pages:
+                self.checkpoint()
+
+    def checkpoint(self):
+        self.zip.close()
+        size = self.zip.start_dir
+        with open(self.path, 'rb') as f:
+            f.seek(size)
+            index = f.read()
+        self.zip = zipfile.ZipFile(self.path, 'a', zipfile.ZIP_STORED)
+        self.unsaved = 0
+        if self.on_checkpoint:
+            self.on_checkpoint(sorted(self.done), size, index)
+
+    def is_full(self, data):
+        if not self.volume_bytes or not self.volume_pages:
+            return False
+        return self.zip.start_dir + 128 * len(self.zip.filelist) + page_size(data) > self.volume_bytes
+
+    def seal(self):
+        self.zip.close()
+        if self.on_seal:
+            self.on_seal(self.path, list(self.volume_pages))
+        self.volume += 1
+        self.path = volume_path(self.base, self.volume)
+        self.zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED)
+        self.volume_pages = []
+        self.unsaved = 0
+        if self.on_checkpoint:
+            self.on_checkpoint(sorted(self.done), 0, None)
+
+    def skip(self, idx):
+        self.missing.append(idx)
+        self.add(idx, None)
+
+    def drop(self, idx):
+        self.dropped.append(idx)
+        self.add(idx, None)
+
+    def remaining(self, urls):
+        pages = []
+        for idx, url in enumerate(urls):
+            if url is None:
+                self.drop(idx)
+            elif idx not in self.done:
+                pages.append((idx, url))
+        return pages
+
+    def close(self):
+        with self.lock:
+            started = time.perf_counter()
+            for idx in sorted(self.pending):
+                if self.pending[idx] is not None:
+                    self.write(idx, self.pending[idx])
+            self.pending.clear()
+            self.zip.close()
+            self.busy += time.perf_counter() - started
+
+
+lazy_load_script = """
+const [selector, placeholders, timeout, quiet, done] = arguments;
+const started = performance.now();
+const root = document.querySelector(selector) || document.body;
+let finished = false;
+let lastChange = performance.now();
+const visited = new WeakSet();
+
+const isPlaceholder = (value) => !value || placeholders.some((p) => value.endsWith(p));
+const isReady = (img) => {
+    const src = img.getAttribute('src');
+    return !isPlaceholder(src) || !isPlaceholder(img.getAttribute('data-src'));
+};
+
+const finish = (ready) => {
+    if (finished) return;
+    finished = true;
+    observer.disconnect();
+    clearInterval(timer);
+    clearTimeout(deadline);
+    const images = Array.from(root.querySelectorAll('img'));
+    done({
+        ready: ready,
+        elapsed: Math.round(performance.now() - started),
+        total: images.length,
+        loaded: images.filter(isReady).length,
+    });
+};
+
+const check = () => {
+    const images = Array.from(root.querySelectorAll('img'));
+    const pending = images.find((img) => !isReady(img) && !visited.has(img));
+    if (pending) {
+        visited.add(pending);
+        pending.scrollIntoView({block: 'center'});
+        return;
+    }
+    const bottom = window.innerHeight + window.scrollY >= document.body.scrollHeight - 2;
+    if (!bottom) {
+        window.scrollBy(0, window.innerHeight);
+        return;
+    }
+    const complete = images.length && images.every(isReady);
+    if (complete && performance.now() - lastChange >= quiet) finish(true);
+};
+
+const observer = new MutationObserver(() => {
+    lastChange = performance.now();
+    check();
+});
+observer.observe(root, {subtree: true, childList: true, attributes: true, attributeFilter: ['src', 'data-src']});
+
+const timer = setInterval(check, 100);
+const deadline = setTimeout(() => finish(false), timeout);
+check();
+"""
+
+
+def wait_for_images(driver, selector, placeholders, timeout=30, quiet=500):
+    driver.set_script_timeout(timeout + 5)
+    result = driver.execute_async_script(lazy_load_script, selector, placeholders, timeout * 1000, quiet)
+    status = "" if result['ready'] else " (таймаут)"
+    metrics.record_stage('scroll', result['elapsed'] / 1000, 'ok' if result['ready'] else 'timeout', images=result['total'])
+    print(f"Изображения подгружены за {result['elapsed'] / 1000:.1f} с: {result['loaded']}/{result['total']}{status}")
+    return result
+
+
+def site_rules(probe_rules, link):
+    host = urlsplit(link).hostname or ''
+    rules = dict(probe_rules['default'])
+    for site, overrides in probe_rules.items():
+        if host == site or host.endswith(f'.{site}'):
+            rules.update(overrides)
+    return rules
+
+
+def skip_pages(probe_rules, link, urls):
+    skip = site_rules(probe_rules, link)['skip']
+    return [url for url in urls if not any(pattern in url for pattern in skip)]
+
+
+async def probe_page(session, url, slot):
+    headers = {'Range': f'bytes=0-{probe_bytes - 1}'}
+    try:
+        async with slot(url), session.get(url, headers=headers, timeout=probe_timeout) as response:
+            if response.status not in (200, 206):
+                return None
+            head = b''
+            async for chunk in response.content.iter_chunked(probe_chunk_size):
+                head += chunk
+                if len(head) >= probe_bytes:
+                    break
+            head = head[:probe_bytes]
+            size = response.content_length if response.status == 200 else None
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                size = int(total)
+            return {
+                'type': response.content_type,
+                'size': size,
+                'dimensions': imaging.header_size(head),
+                'hash': hashlib.sha1(head).hexdigest(),
+            }
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Не удалось проверить {url}: {e!r}")
+        return None
+
+
+def probe_verdict(info, rules, seen):
+    if info['dimensions'] is None and not info['type'].startswith('image/'):
+        return 'type'
+    if rules.get('min_bytes') and info['size'] is not None and info['size'] < rules['min_bytes']:
+        return 'small'
+    if info['dimensions']:
+        width, height = info['dimensions']
+        if width < rules.get('min_width', 0) or height < rules.get('min_height', 0):
+            return 'small'
+        if rules.get('banner_ratio') and width >= height * rules['banner_ratio']:
+            return 'banner'
+    if rules.get('duplicates'):
+        fingerprint = (info['hash'], info['size'])
+        if fingerprint in seen:
+            return 'duplicate'
+        seen.add(fingerprint)
+    return None
+
+
+async def probe_pages(session, link, urls, probe_rules, slot):
+    rules = site_rules(probe_rules, link)
+    if not probe_bytes or not urls:
+        return urls
+
+    with metrics.timed_stage('probe', link=link, pages=len(urls)):
+        results = await asyncio.gather(*[probe_page(session, url, slot) for url in urls])
+
+    seen = set()
+    checked = []
+    dropped = {}
+    for url, info in zip(urls, results):
+        reason = probe_verdict(info, rules, seen) if info else None
+        if reason is None:
+            checked.append(url)
+            continue
+        checked.append(None)
+        dropped[reason] = dropped.get(reason, 0) + 1
+        metrics.inc('probe_dropped_total', reason=reason)
+
+    if dropped:
+        details = ', '.join(f"{reason}: {count}" for reason, count in dropped.items())
+        print(f"Проверка страниц: отброшено {sum(dropped.values())} из {len(urls)} ({details})")
+    if sum(dropped.values()) == len(urls):
+        print("Проверка отбросила все страницы, оставляю исходный список")
+        return urls
+    return checked
+
+
+def chapter_number(url):
+    match = re.search(r'(\d+)(?:\.html?)?/?$', urlsplit(url).path)
+    return int(match[1]) if match else 0
+
+
+def series_chapters(link, html):
+    soup = BeautifulSoup(html, 'html.parser')
+    index = urlsplit(link)
+    prefix = re.sub(r'\.html?$', '', index.path).rstrip('/') + '/'
+
+    chapters = {}
+    for anchor in soup.find_all('a', href=True):
+        url = urljoin(link, anchor['href']).split('#')[0]
+        parts = urlsplit(url)
+        if parts.netloc != index.netloc or not parts.path.startswith(prefix):
+            continue
+        if chapter_link_pattern.search(parts.path[len(prefix):]):
+            chapters.setdefault(url, anchor.get_text(strip=True))
+
+    chapters = list(chapters.items())
+    if len(chapters) > 1 and chapter_number(chapters[0][0]) > chapter_number(chapters[-1][0]):
+        chapters.reverse()
+    return chapters
+
+
+def select_chapters(chapters, selection):
+    match = re.fullmatch(r'(\d*)(-?)(\d*)', selection)
+    if not match:
+        return None
+    first = int(match[1]) if match[1] else 1
+    last = int(match[3]) if match[3] else (len(chapters) if match[2] or not match[1] else first)
+    if first < 1 or last < first:
+        return None
+    return chapters[first - 1:last]
+
+
+class Pipeline:
+    failed_text = "Не удалось скачать главу: {link}"
+    done_text = None
+
+    def __init__(self, name, store, cache, queue, output_folder, upload_concurrency, buffer_size):
+        self.name = name
+        self.store = store
+        self.cache = cache
+        self.queue = queue
+        self.output_folder = output_folder
+        self.inflight = {}
+        self.upload_slots = asyncio.Semaphore(upload_concurrency)
+        self.download_buffer = asyncio.Queue(buffer_size)
+        self.upload_buffer = asyncio.Queue(buffer_size)
+
+    def label(self, job, number):
+        if not number:
+            return f"{job.title}.zip", None
+        return f"{job.title}_{number}.zip", f"Часть {number}"
+
+    def archive_path(self, job):
+        return os.path.join(self.output_folder, f"{self.name}_{job.id}.zip")
+
+    def submit(self, job):
+        self.queue.put(job)
+        self.track(job)
+
+    def track(self, job):
+        self.inflight.setdefault(self.cache.key(job.link, job.folder_name), job)
+
+    def untrack(self, job):
+        key = self.cache.key(job.link, job.folder_name)
+        if self.inflight.get(key) is job:
+            del self.inflight[key]
+
+    def running(self, link, folder_name):
+        return self.inflight.get(self.cache.key(link, folder_name))
+
+    async def join(self, job, chat_id):
+        if not job.attach(chat_id):
+            return False
+        self.queue.bump(job)
+        metrics.inc('jobs_coalesced_total')
+        for volume in job.volumes:
+            if volume['file_id']:
+                await self.store.bot.send_document(chat_id, volume['file_id'], caption=volume['caption'])
+        return True
+
+    async def send_cached(self, chat_id, entry):
+        bot = self.store.bot
+        try:
+            for volume in entry.get('volumes', []):
+                await bot.send_document(chat_id, volume['file_id'], caption=volume['caption'])
+        except TelegramBadRequest as e:
+            print(f"file_id части из кэша не принят: {e}")
+            return False
+
+        try:
+            await bot.send_document(chat_id, entry['file_id'], caption=entry['caption'])
+            return True
+        except TelegramBadRequest as e:
+            print(f"file_id из кэша не принят: {e}")
+
+        if entry['path'] and os.path.exists(entry['path']):
+            file = types.FSInputFile(entry['path'], filename=entry['filename'])
+            sent = await bot.send_document(chat_id, file, caption=entry['caption'])
+            entry['file_id'] = sent.document.file_id
+            self.cache.save()
+            return True
+        return False
+
+    async def upload_worker(self):
+        held = {}
+        while True:
+            job = await self.upload_buffer.get()
+            if job.series is None:
+                await self.deliver(job)
+                continue
+
+            waiting = held.setdefault(job.series, {})
+            waiting[job.series_index] = job
+            while waiting:
+                next_index = self.store.next_in_series(job.series)
+                if next_index not in waiting:
+                    break
+                await self.deliver(waiting.pop(next_index))
+            if not waiting:
+                del held[job.series]
+
+    def seal_volume(self, job, path, pages):
+        number = len(job.volumes) + 1
+        filename, caption = self.label(job, number)
+        volume = {'path': path, 'pages': pages, 'filename': filename, 'caption': caption, 'file_id': None}
+        job.volumes.append(volume)
+        self.store.set_volumes(job.id, job.volumes)
+        print(f"Часть {number} главы {job.link} готова: {len(pages)} стр.")
+        if job.series is None or self.store.next_in_series(job.series) == job.series_index:
+            job.uploads.append(asyncio.create_task(self.upload_volume(job, volume)))
+
+    async def upload_volume(self, job, volume):
+        async with self.upload_slots:
+            file = types.FSInputFile(volume['path'], filename=volume['filename'])
+            with metrics.timed_stage('upload', job=job.id, bytes=os.path.getsize(volume['path'])):
+                sent = await job.answer_document(file, caption=volume['caption'])
+        volume['file_id'] = sent.document.file_id
+        self.store.set_volumes(job.id, job.volumes)
+        os.remove(volume['path'])
+
+    async def finish_volumes(self, job):
+        for error in await asyncio.gather(*job.uploads, return_exceptions=True):
+            if isinstance(error, Exception):
+                print(f"Не удалось отправить часть главы {job.link}: {error}")
+        job.uploads = []
+        await asyncio.gather(*[self.upload_volume(job, volume) for volume in job.volumes if volume['file_id'] is None])
+
+    async def deliver(self, job):
+        archive_path = self.archive_path(job)
+        interrupted = False
+        outcome = 'error'
+        self.untrack(job)
+        try:
+            if job.cached is not None:
+                if await self.send_cached(job.chat_id, job.cached):
+                    outcome = 'cached'
+                    for chat_id in job.waiters:
+                        await self.send_cached(chat_id, job.cached)
+                else:
+                    self.cache.invalidate(job.link, job.folder_name)
+                    job.cached = None
+                    job.skip_cache = True
+                    outcome = 'requeued'
+                    self.submit(job)
+                return
+
+            await self.finish_volumes(job)
+            if job.error is not None:
+                await job.answer(f"Произошла ошибка: {job.error}")
+                return
+
+            result = job.result
+            if result is None or not result.total or len(result.missing) + len(result.dropped) == result.total:
+                outcome = 'failed'
+                await job.answer(self.failed_text.format(link=job.link))
+                return
+
+            filename, caption = self.label(job, len(job.volumes) + 1 if job.volumes else 0)
+            captions = [caption] if caption else []
+            if not result.complete:
+                captions.append(f"Не скачаны страницы ({len(result.missing)} из {result.total}): {result.describe_missing()}")
+            if result.dropped:
+                captions.append(f"Отброшены при проверке ({len(result.dropped)}): {result.describe_dropped()}")
+            caption = '\n'.join(captions)[:1024] or None
+            path = volume_path(archive_path, len(job.volumes))
+            file = types.FSInputFile(path, filename=filename)
+            async with self.upload_slots:
+                with metrics.timed_stage('upload', job=job.id, bytes=os.path.getsize(path)):
+                    sent = await job.answer_document(file, caption=caption)
+            outcome = 'sent' if result.complete else 'partial'
+            if result.complete:
+                self.cache.put(job.link, job.folder_name, sent.document.file_id, filename, caption, path, job.volumes)
+            if self.done_text and job.series is None:
+                await job.answer(self.done_text)
+            print(f"Глава {job.link} загружена, пропущено страниц: {len(result.missing)}.")
+        except asyncio.CancelledError:
+            interrupted = True
+            outcome = 'interrupted'
+            raise
+        except Exception as e:
+            print(f"Ошибка при отправке главы {job.link}: {e}")
+            try:
+                await job.answer(f"Произошла ошибка: {e}")
+            except Exception as send_error:
+                print(f"Не удалось сообщить об ошибке {job.chat_id}: {send_error}")
+        finally:
+            if outcome != 'requeued':
+                duration = time.monotonic() - job.started
+                self.queue.record(duration)
+                metrics.inc('jobs_total', result=outcome)
+                metrics.log('job', job=job.id, link=job.link, series=job.series, result=outcome, seconds=round(duration, 3))
+                if not interrupted:
+                    self.store.remove(job.id)
+                    for number in range(len(job.volumes) + 1):
+                        if os.path.exists(volume_path(archive_path, number)):
+                            os.remove(volume_path(archive_path, number))
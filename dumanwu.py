@@ -1,29 +1,35 @@
 import os
 import time
-import requests
-import shutil
+import random
 import asyncio
 import re
 import ssl
+import tempfile
+import aiohttp
 import urllib3
 
-from urllib.parse import urljoin
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlsplit
+
+import chapters
+import imaging
+import metrics
 
 from tqdm import tqdm
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
+from bs4 import BeautifulSoup
+from aiogram import Bot, Dispatcher
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import WebDriverException
 from webdriver_manager.chrome import ChromeDriverManager
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 ssl._create_default_https_context = ssl._create_unverified_context
 
-TOKEN = ''
+TOKEN = os.getenv('TOKEN', '')
 
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
@@ -35,127 +41,439 @@ chrome_options.add_argument('--disable-dev-shm-usage')
 chrome_options.add_argument('--ignore-ssl-errors=yes')
 chrome_options.add_argument('--allow-insecure-localhost')
 chrome_options.add_argument('--ignore-certificate-errors')
+chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+chrome_options.page_load_strategy = 'eager'
 
-driver = webdriver.Chrome(
-    service=Service(ChromeDriverManager().install()), 
-    options=chrome_options
-)
+blocked_urls = [
+    '*.jpg*', '*.jpeg*', '*.png*', '*.webp*', '*.gif*', '*.avif*', '*.bmp*', '*.ico*', '*.svg*',
+    '*.mp4*', '*.webm*', '*.m3u8*', '*.mp3*', '*.woff*', '*.ttf*', '*.otf*', '*.eot*',
+    '*googlesyndication.com*', '*doubleclick.net*', '*google-analytics.com*', '*googletagmanager.com*',
+    '*hm.baidu.com*', '*cnzz.com*', '*51.la*',
+]
 
 output_folder = 'images'
 os.makedirs(output_folder, exist_ok=True)
 
 allowed_users = []
 
+jobs_file = 'dumanwu_jobs.db'
+archive_checkpoint_pages = 10
+archive_volume_bytes = 45 * 1024 ** 2
+upload_concurrency = 2
+
+cache_file = 'dumanwu_cache.json'
+cache_folder = 'dumanwu_cache'
+cache_max_bytes = 2 * 1024 ** 3
+cache_max_entries = 5000
+
+worker_count = 2
+render_workers = 1
+pipeline_buffer = 2
+series_chapter_limit = 300
+metrics_port = 9102
+host_limits = {'render': 2, 'fetch': 16}
+
+image_processing = None
+# image_processing = {'format': 'JPEG', 'quality': 85, 'max_width': 1600, 'target_size': 1024 * 1024, 'split_height': 6000}
+
+download_retries = 4
+download_chunk_size = 64 * 1024
+download_spool_size = 8 * 1024 * 1024
+download_timeout = aiohttp.ClientTimeout(total=120, sock_connect=15, sock_read=30)
+
+probe_rules = {
+    'default': {'skip': ['.html'], 'duplicates': True},
+    'dumanwu.com': {'banner_ratio': 3},
+    # 'dumanwu.com': {'banner_ratio': 3, 'min_bytes': 2 * 1024, 'min_width': 200, 'min_height': 100},
+}
+
+user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'
+placeholder_images = ['/static/images/load.gif']
+image_url_pattern = re.compile(r'https?:(?:\\?/){2}[^"\'\s<>()]+?\.(?:jpe?g|png|webp)(?:\?[^"\'\s<>()]*)?', re.IGNORECASE)
+
 def sanitize_folder_name(folder_name):
     return re.sub(r'[<>:"/\\|?*]', '', folder_name.replace(" ", "_"))
 
-def scroll_to_bottom():
-    last_height = driver.execute_script("return document.body.scrollHeight")
-    while True:
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        time.sleep(1)
-        new_height = driver.execute_script("return document.body.scrollHeight")
-        if new_height == last_height:
-            break
-        last_height = new_height
-
-def download_image(chapter_folder, url, idx, progress_bar):
-    try:
-        response = requests.get(url, stream=True, verify=False)
-        if response.status_code == 200:
-            with open(os.path.join(chapter_folder, f'{idx}.jpg'), 'wb') as out_file:
-                shutil.copyfileobj(response.raw, out_file)
-            progress_bar.update(1)
+host_slot = chapters.HostSlots(host_limits).slot
+
+class AdaptiveLimit:
+    def __init__(self, maximum, start=4, minimum=1):
+        self.limit = min(start, maximum)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.latency = None
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def success(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        if latency > self.latency * 2:
+            self.limit = max(self.minimum, self.limit * 0.75)
         else:
-            print(f"Ошибка загрузки {idx}: {response.status_code}")
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.latency = 0.9 * self.latency + 0.1 * latency
+
+    def failure(self):
+        self.limit = max(self.minimum, self.limit / 2)
+
+host_limiters = {}
+
+def host_limiter(url):
+    host = urlsplit(url).hostname
+    if host not in host_limiters:
+        host_limiters[host] = AdaptiveLimit(host_limits['fetch'])
+    return host_limiters[host]
+
+def create_session():
+    connector = aiohttp.TCPConnector(
+        limit_per_host=host_limits['fetch'],
+        keepalive_timeout=60,
+        ssl=False,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={'User-Agent': user_agent},
+        timeout=download_timeout,
+    )
+
+def create_driver():
+    driver = webdriver.Chrome(
+        service=Service(ChromeDriverManager().install()),
+        options=chrome_options
+    )
+    if blocked_urls:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked_urls})
+    return driver
+
+class Browser:
+    def __init__(self):
+        self.driver = None
+
+    def render(self, link):
+        if self.driver is None:
+            self.driver = create_driver()
+        try:
+            return render_chapter(self.driver, link)
+        except WebDriverException:
+            self.quit()
+            raise
+
+    def quit(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+            self.driver = None
+
+job_store = chapters.JobStore(jobs_file, bot)
+download_queue = chapters.FairQueue(worker_count)
+chapter_cache = chapters.ChapterCache(cache_file, cache_folder, cache_max_bytes, cache_max_entries)
+
+class ChapterPipeline(chapters.Pipeline):
+    failed_text = "Не удалось скачать изображения. Проверьте ссылку: {link}"
+    done_text = "Загрузка завершена!"
+
+pipeline = ChapterPipeline('dumanwu', job_store, chapter_cache, download_queue, output_folder, upload_concurrency, pipeline_buffer)
+
+async def fetch_page(session, url, idx):
+    limiter = host_limiter(url)
+    page = tempfile.SpooledTemporaryFile(max_size=download_spool_size)
+    for attempt in range(download_retries):
+        offset = page.tell()
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            async with limiter:
+                started = time.monotonic()
+                async with session.get(url, headers=headers) as response:
+                    if response.status in (200, 206):
+                        limiter.success(time.monotonic() - started)
+                        if response.status == 200 and offset:
+                            page.seek(0)
+                            page.truncate()
+                        async for chunk in response.content.iter_chunked(download_chunk_size):
+                            page.write(chunk)
+                            metrics.inc('download_bytes_total', len(chunk))
+                        page.seek(0)
+                        metrics.inc('download_pages_total', result='ok')
+                        return page
+                    if response.status == 416:
+                        page.seek(0)
+                        page.truncate()
+                    elif response.status < 500 and response.status != 429:
+                        print(f"Ошибка загрузки {idx}: {response.status}")
+                        page.close()
+                        metrics.inc('download_pages_total', result='failed')
+                        return None
+                    limiter.failure()
+                    print(f"Ошибка загрузки {idx}: {response.status}, попытка {attempt + 1}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            limiter.failure()
+            print(f"Ошибка при загрузке изображения {idx}: {e!r}, попытка {attempt + 1}")
+        metrics.inc('download_retries_total')
+        await asyncio.sleep(0.5 * 2 ** attempt + random.random())
+    page.close()
+    metrics.inc('download_pages_total', result='failed')
+    return None
+
+async def download_image(session, archive, url, idx, progress_bar):
+    page = await fetch_page(session, url, idx)
+    if page is None:
+        archive.skip(idx)
+        progress_bar.update(1)
+        return
+
+    if image_processing:
+        page = await imaging.process_file(page, **image_processing)
+    archive.add(idx, page)
+    progress_bar.update(1)
+
+def page_extension():
+    if image_processing and image_processing.get('format') == 'WEBP':
+        return 'webp'
+    return 'jpg'
+
+def is_placeholder(src):
+    return not src or any(src.endswith(placeholder) for placeholder in placeholder_images)
+
+def page_urls(link, images):
+    urls = []
+    for src, data_src in images:
+        if is_placeholder(src):
+            src = data_src
+        if not src:
+            continue
+        urls.append(urljoin(link, src))
+    return chapters.skip_pages(probe_rules, link, list(dict.fromkeys(urls)))
+
+def chapter_title(title, folder_name=None):
+    if folder_name:
+        title = folder_name
+    else:
+        if title:
+            title = title.split('漫画 - 读漫屋')[0].strip()
+        if not title:
+            title = 'БезНазвания'
+    return sanitize_folder_name(title)
+
+def parse_chapter_html(link, html):
+    soup = BeautifulSoup(html, 'html.parser')
+    title = soup.title.get_text(strip=True) if soup.title else ''
+
+    container = soup.find(class_='main_img')
+    images = []
+    if container:
+        images = [(img.get('src'), img.get('data-src')) for img in container.find_all('img')]
+    urls = page_urls(link, images)
+
+    if not urls:
+        scripts = '\n'.join(script.string or '' for script in soup.find_all('script'))
+        found = [url.replace('\\/', '/') for url in image_url_pattern.findall(scripts)]
+        urls = page_urls(link, [(url, None) for url in found])
+
+    return title, urls
+
+async def fetch_chapter(session, link):
+    try:
+        async with host_slot('render', link), session.get(link) as response:
+            if response.status != 200:
+                print(f"Быстрый путь: страница вернула {response.status}")
+                return None, []
+            html = await response.text(errors='replace')
     except Exception as e:
-        print(f"Ошибка при загрузке изображения {idx}: {e}")
-    finally:
-        if 'response' in locals():
-            del response
+        print(f"Быстрый путь: не удалось получить страницу: {e}")
+        return None, []
+    return parse_chapter_html(link, html)
+
+def render_chapter(driver, link):
+    driver.get(link)
+    chapters.wait_for_images(driver, '.main_img', placeholder_images)
 
-def download_images(link, custom_folder_name=None):
+    container = driver.find_element(By.CLASS_NAME, 'main_img')
+    images = [
+        (img.get_attribute('src'), img.get_attribute('data-src'))
+        for img in container.find_elements(By.TAG_NAME, 'img')
+    ]
+    return driver.title, page_urls(link, images)
+
+async def collect_pages(session, link, browser):
+    with metrics.timed_stage('extract', link=link) as fields:
+        title, urls = await fetch_chapter(session, link)
+        fields['pages'] = len(urls)
+    if urls:
+        print(f"Быстрый путь: найдено {len(urls)} страниц")
+    else:
+        print("Быстрый путь не нашёл страниц, открываю браузер")
+        async with host_slot('render', link):
+            with metrics.timed_stage('render', link=link):
+                title, urls = await asyncio.to_thread(browser.render, link)
+    return title, await chapters.probe_pages(session, link, urls, probe_rules, host_limiter)
+
+async def fetch_series(session, link):
+    async with host_slot('render', link), session.get(link) as response:
+        response.raise_for_status()
+        return chapters.series_chapters(link, await response.text(errors='replace'))
+
+async def download_images(session, job, archive_path):
+    archive = chapters.ChapterArchive(
+        archive_path, page_extension(), job.pages, job.archive_size, job.archive_index,
+        lambda pages, size, index: job_store.checkpoint(job.id, pages, size, index),
+        [volume['pages'] for volume in job.volumes], archive_volume_bytes,
+        lambda path, pages: pipeline.seal_volume(job, path, pages), archive_checkpoint_pages,
+    )
+    pages = archive.remaining(job.urls)
+    if archive.done:
+        print(f"Продолжаю {job.link}: уже скачано {len(archive.done)} из {len(job.urls)}")
     try:
-        driver.get(link)
-        scroll_to_bottom()
+        with metrics.timed_stage('download', job=job.id, pages=len(pages)), \
+                tqdm(total=len(pages), desc="Скачивание изображений", unit="img") as progress_bar:
+            await asyncio.gather(*[
+                download_image(session, archive, url, idx, progress_bar)
+                for idx, url in pages
+            ])
+    finally:
+        archive.close()
+        metrics.record_stage('archive', archive.busy, job=job.id, pages=len(archive.done))
 
-        if custom_folder_name:
-            title = custom_folder_name
-        else:
-            title = driver.title
-            if title:
-                title = title.split('漫画 - 读漫屋')[0].strip()
-            if not title:
-                title = 'БезНазвания'
-
-        title = sanitize_folder_name(title)
-        chapter_folder = os.path.join(output_folder, title)
-
-        if not os.path.exists(chapter_folder):
-            os.makedirs(chapter_folder)
-
-        print(f"Создана папка: {chapter_folder}")
-
-        container = driver.find_element(By.CLASS_NAME, 'main_img')
-        
-        images = container.find_elements(By.TAG_NAME, 'img')
-        urls = []
-        for idx, img in enumerate(images):
-            src = img.get_attribute('src')
-            if src == 'https://dumanwu.com/static/images/load.gif':
-                src = img.get_attribute('data-src')
-            img_url = urljoin(link, src)
-            if img_url.endswith('.html') or img_url.endswith('.png'):
-                continue
-            else:
-                urls.append(img_url)
-
-        with tqdm(total=len(urls), desc="Скачивание изображений", unit="img") as progress_bar:
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                futures = [
-                    executor.submit(download_image, chapter_folder, url, idx, progress_bar) 
-                    for idx, url in enumerate(urls)
-                ]
-                
-                for future in as_completed(futures):
-                    future.result()
-
-        return chapter_folder
-    except Exception as e:
-        print(f"Ошибка при скачивании изображений: {e}")
-        return None
+    return chapters.ChapterResult(job.title, len(job.urls), sorted(archive.missing), sorted(archive.dropped))
 
-download_queue = asyncio.Queue()
+async def render_worker(worker, session):
+    browser = Browser()
+    try:
+        while True:
+            job = await download_queue.get()
+            job.started = time.monotonic()
+            try:
+                job.cached = None if job.skip_cache else chapter_cache.get(job.link, job.folder_name)
+                if job.cached is None and job.urls is None:
+                    if job.series is None:
+                        await job.answer("Скачиваю изображения, это может занять немного времени...")
+                    title, job.urls = await collect_pages(session, job.link, browser)
+                    job.title = chapter_title(title, job.folder_name)
+                    job_store.set_urls(job.id, job.title, job.urls)
+            except Exception as e:
+                print(f"[render {worker}] Ошибка при разборе {job.link}: {e}")
+                job.error = e
+            await pipeline.download_buffer.put(job)
+            metrics.set_gauge('pipeline_buffer', pipeline.download_buffer.qsize(), stage='download')
+    finally:
+        browser.quit()
 
-async def process_download_queue():
+async def download_worker(worker, session):
     while True:
-        link, custom_folder_name, message = await download_queue.get()
+        job = await pipeline.download_buffer.get()
+        if job.cached is None and job.error is None and job.urls:
+            try:
+                print(f"[{worker}] Создан архив: {job.title}.zip")
+                job.result = await download_images(session, job, pipeline.archive_path(job))
+            except Exception as e:
+                print(f"[download {worker}] Ошибка при загрузке {job.link}: {e}")
+                job.error = e
+        await pipeline.upload_buffer.put(job)
+        metrics.set_gauge('pipeline_buffer', pipeline.upload_buffer.qsize(), stage='upload')
 
+def start_workers(session):
+    return (
+        [asyncio.create_task(render_worker(worker, session)) for worker in range(render_workers)]
+        + [asyncio.create_task(download_worker(worker, session)) for worker in range(worker_count)]
+        + [asyncio.create_task(pipeline.upload_worker())]
+    )
+
+async def resume_jobs():
+    for job in job_store.pending():
+        pipeline.submit(job)
+        print(f"Возвращаю в очередь {job.link}")
         try:
-            await message.answer("Скачиваю изображения, это может занять немного времени...")
-            chapter_folder = download_images(link, custom_folder_name)
-
-            if chapter_folder and os.path.exists(chapter_folder):
-                print("Создание архива...")
-                archive_path = shutil.make_archive(chapter_folder, 'zip', chapter_folder)
-                file = types.FSInputFile(archive_path)
-                await message.answer_document(file)
-                await message.answer("Загрузка завершена!")
-            else:
-                await message.answer("Не удалось скачать изображения. Проверьте ссылку.")
-            print("Загрузка завершена.")
+            await job.answer(f"Бот перезапущен, продолжаю загрузку: {job.link}")
         except Exception as e:
-            await message.answer(f"Произошла ошибка: {e}")
-        finally:
-            if chapter_folder and os.path.exists(chapter_folder):
-                shutil.rmtree(chapter_folder)
-            if chapter_folder and os.path.exists(f"{chapter_folder}.zip"):
-                os.remove(f"{chapter_folder}.zip")
-            download_queue.task_done()
+            print(f"Не удалось уведомить {job.chat_id}: {e}")
 
 @dp.message(Command('start'))
 async def start(message: Message):
-    await message.answer("Привет! Отправь мне ссылку на главу, и я скачаю изображения с неё в виде архива.")
+    await message.answer(
+        "Привет! Отправь мне ссылку на главу, и я скачаю изображения с неё в виде архива.\n"
+        "Целый тайтл: /series <ссылка на страницу тайтла> [с-по]"
+    )
+
+@dp.message(Command('queue'))
+async def queue_status(message: Message):
+    if message.from_user.id not in allowed_users:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+
+    jobs = download_queue.jobs.get(message.from_user.id)
+    if not jobs:
+        await message.answer("Ваших ссылок в очереди нет.")
+        return
+
+    lines = [
+        f"{download_queue.position(job)}. {job.link} — {chapters.format_eta(download_queue.eta(job))}"
+        for job in jobs
+    ]
+    await message.answer("Ваши ссылки в очереди:\n" + "\n".join(lines))
+
+@dp.message(Command('forget'))
+async def forget(message: Message, command: CommandObject):
+    if message.from_user.id not in allowed_users:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+
+    if not command.args:
+        await message.answer("Использование: /forget <ссылка> [название]")
+        return
+
+    parts = command.args.strip().split(" ", 1)
+    removed = chapter_cache.invalidate(parts[0], parts[1] if len(parts) > 1 else None)
+    await message.answer(f"Удалено из кэша: {removed}")
+
+@dp.message(Command('series'))
+async def series(message: Message, command: CommandObject):
+    if message.from_user.id not in allowed_users:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+
+    parts = (command.args or '').split()
+    if not parts or not parts[0].startswith(('http://', 'https://')):
+        await message.answer("Использование: /series <ссылка на страницу тайтла> [с-по], например: /series <ссылка> 1-20")
+        return
+
+    try:
+        async with create_session() as session:
+            found = await fetch_series(session, parts[0])
+    except Exception as e:
+        await message.answer(f"Не удалось открыть оглавление: {e}")
+        return
+    if not found:
+        await message.answer("Не нашёл глав на странице.")
+        return
+
+    selected = chapters.select_chapters(found, parts[1] if len(parts) > 1 else '')
+    if not selected:
+        await message.answer(f"Неверный диапазон. Всего глав: {len(found)}.")
+        return
+
+    selected = selected[:series_chapter_limit]
+    series_id = f"{message.chat.id}:{message.message_id}"
+    for series_index, (link, _) in enumerate(selected):
+        job = job_store.create(link, None, message, series_id, series_index)
+        pipeline.submit(job)
+    await message.answer(
+        f"В очередь добавлено глав: {len(selected)} из {len(found)}. Архивы придут по порядку, "
+        f"ожидание {chapters.format_eta(download_queue.eta(job))}"
+    )
 
 @dp.message()
 async def handle_message(message: Message):
@@ -165,17 +483,47 @@ async def handle_message(message: Message):
 
     parts = message.text.strip().split(" ", 1)
     link = parts[0]
-    custom_folder_name = parts[1] if len(parts) > 1 else None
+    folder_name = parts[1] if len(parts) > 1 else None
 
     if link.startswith('http://') or link.startswith('https://'):
-        await message.answer("Ссылка добавлена в очередь. Загрузка начнется автоматически.")
-        await download_queue.put((link, custom_folder_name, message))
+        entry = chapter_cache.get(link, folder_name)
+        if entry is not None:
+            if await pipeline.send_cached(message.chat.id, entry):
+                print(f"Глава {link} отправлена из кэша.")
+                return
+            chapter_cache.invalidate(link, folder_name)
+
+        job = pipeline.running(link, folder_name)
+        if job is not None:
+            if not await pipeline.join(job, message.chat.id):
+                await message.answer("Эта глава уже в очереди.")
+                return
+            position = download_queue.position(job)
+            await message.answer(
+                "Эту главу уже скачивают по другому запросу, архив придёт и вам. "
+                + (f"Позиция: {position}" if position else "Загрузка уже идёт.")
+            )
+            return
+
+        job = job_store.create(link, folder_name, message)
+        pipeline.submit(job)
+        await message.answer(
+            f"Ссылка добавлена в очередь. Позиция: {download_queue.position(job)}, "
+            f"ожидание {chapters.format_eta(download_queue.eta(job))}"
+        )
     else:
         await message.answer("Неверная ссылка.")
 
 async def main():
-    asyncio.create_task(process_download_queue())
-    await dp.start_polling(bot)
+    await metrics.start('dumanwu', metrics_port)
+    async with create_session() as session:
+        await resume_jobs()
+        start_workers(session)
+        try:
+            await dp.start_polling(bot)
+        finally:
+            await metrics.stop()
+            imaging.shutdown()
 
 if __name__ == '__main__':
     asyncio.run(main())
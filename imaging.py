@@ -0,0 +1,128 @@
+import io
+import os
+import math
+import asyncio
+
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageFile
+
+Image.MAX_IMAGE_PIXELS = 200_000_000
+
+executor = None
+max_workers = os.cpu_count()
+min_quality = 40
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    return executor
+
+
+def shutdown():
+    global executor
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+        executor = None
+
+
+def to_rgb(image):
+    if image.mode in ('RGB', 'L'):
+        return image
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def downscale(image, max_width=None, max_height=None):
+    width, height = image.size
+    scale = min(
+        max_width / width if max_width else 1,
+        max_height / height if max_height else 1,
+        1,
+    )
+    if scale >= 1:
+        return image
+    return image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+
+def split_strip(image, split_height):
+    width, height = image.size
+    if not split_height or height <= split_height * 1.5:
+        return [image]
+
+    parts = math.ceil(height / split_height)
+    step = math.ceil(height / parts)
+    return [image.crop((0, top, width, min(height, top + step))) for top in range(0, height, step)]
+
+
+def encode(image, format, quality, target_size=None):
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format, quality=quality, optimize=format == 'JPEG')
+        data = buffer.getvalue()
+        if not target_size or len(data) <= target_size or quality <= min_quality:
+            return data
+        quality = max(min_quality, quality - 10)
+
+
+def process_image(data, format='JPEG', quality=85, max_width=None, max_height=None,
+                  target_size=None, split_height=None, force=False):
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+
+    fits = (
+        (not max_width or width <= max_width)
+        and (not max_height or height <= max_height)
+        and (not target_size or len(data) <= target_size)
+        and (not split_height or height <= split_height * 1.5)
+    )
+    if not force and fits and image.format == format:
+        return [data]
+
+    image = downscale(to_rgb(image), max_width, max_height)
+    return [encode(part, format, quality, target_size) for part in split_strip(image, split_height)]
+
+
+def image_extension(data):
+    if data.startswith(b'\xff\xd8'):
+        return 'jpg'
+    if data.startswith(b'\x89PNG'):
+        return 'png'
+    if data.startswith(b'GIF8'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[4:12] in (b'ftypavif', b'ftypavis'):
+        return 'avif'
+    return None
+
+
+def header_size(data):
+    parser = ImageFile.Parser()
+    try:
+        parser.feed(data)
+    except Exception:
+        return None
+    return parser.image.size if parser.image else None
+
+
+async def process(data, **options):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), partial(process_image, data, **options))
+
+
+async def process_file(file, **options):
+    with file:
+        data = file.read()
+    try:
+        return await process(data, **options)
+    except Exception as e:
+        print(f"Не удалось обработать изображение: {e}")
+        return [data]
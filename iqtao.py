@@ -1,20 +1,30 @@
 import os
 import re
 import time
-import shutil
+import random
 import asyncio
+import tempfile
 import aiohttp
-import aiofiles
+import psutil
+
+from contextlib import asynccontextmanager
+from urllib.parse import urljoin
+
+import chapters
+import imaging
+import metrics
 
 from tqdm import tqdm
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from bs4 import BeautifulSoup
+from aiogram import Bot, Dispatcher, F
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
 
-TOKEN = '...'
+TOKEN = os.getenv('TOKEN', '...')
 
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
@@ -22,7 +32,51 @@ dp = Dispatcher()
 output_folder = 'images'
 os.makedirs(output_folder, exist_ok=True)
 
-active_downloads = asyncio.Queue()
+user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'
+placeholder_images = ['/images/loading_bak.png']
+image_url_pattern = re.compile(r'https?:(?:\\?/){2}[^"\'\s<>()]+?\.(?:jpe?g|png|webp)(?:\?[^"\'\s<>()]*)?', re.IGNORECASE)
+
+jobs_file = 'iqtao_jobs.db'
+archive_checkpoint_pages = 10
+archive_volume_bytes = 45 * 1024 ** 2
+upload_concurrency = 2
+
+cache_file = 'iqtao_cache.json'
+cache_folder = 'iqtao_cache'
+cache_max_bytes = 2 * 1024 ** 3
+cache_max_entries = 5000
+
+worker_count = 2
+host_limits = {'render': 2, 'fetch': 8}
+
+image_processing = None
+# image_processing = {'format': 'JPEG', 'quality': 85, 'max_width': 1600, 'target_size': 1024 * 1024, 'split_height': 6000}
+
+download_concurrency = 8
+download_retries = 4
+download_chunk_size = 64 * 1024
+download_spool_size = 8 * 1024 * 1024
+download_timeout = aiohttp.ClientTimeout(total=120, sock_connect=15, sock_read=30)
+
+probe_rules = {
+    'default': {'skip': [], 'duplicates': True},
+    'iqtao.cn': {'skip': ['floatW']},
+    # 'iqtao.cn': {'skip': ['floatW'], 'min_bytes': 2 * 1024, 'min_width': 200, 'min_height': 100, 'banner_ratio': 4},
+}
+
+driver_pool_size = worker_count
+blocked_urls = [
+    '*.jpg*', '*.jpeg*', '*.png*', '*.webp*', '*.gif*', '*.avif*', '*.bmp*', '*.ico*', '*.svg*',
+    '*.mp4*', '*.webm*', '*.m3u8*', '*.mp3*', '*.woff*', '*.ttf*', '*.otf*', '*.eot*',
+    '*googlesyndication.com*', '*doubleclick.net*', '*google-analytics.com*', '*googletagmanager.com*',
+    '*hm.baidu.com*', '*cnzz.com*', '*51.la*',
+]
+pipeline_buffer = 2
+series_chapter_limit = 300
+metrics_port = 9101
+driver_max_pages = 50
+driver_max_memory = 1024 * 1024 * 1024
+
 allowed_users = [
     370247555,
     ...
@@ -33,80 +87,374 @@ def sanitize_folder_name(folder_name):
     return re.sub(r'[<>:"/\\|?*]', '', folder_name)
 
 
-def scroll_to_bottom(driver):
-    last_height = driver.execute_script("return document.body.scrollHeight")
-    while True:
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        time.sleep(1)
-        new_height = driver.execute_script("return document.body.scrollHeight")
-        if new_height == last_height:
-            break
-        last_height = new_height
+host_slot = chapters.HostSlots(host_limits).slot
+job_store = chapters.JobStore(jobs_file, bot)
+active_downloads = chapters.FairQueue(worker_count)
+chapter_cache = chapters.ChapterCache(cache_file, cache_folder, cache_max_bytes, cache_max_entries)
 
 
-def selenium_task(link):
+class ChapterPipeline(chapters.Pipeline):
+    def label(self, job, number):
+        name = sanitize_folder_name(job.folder_name)
+        if not number:
+            return f"{name}.zip", f"Глава: {job.folder_name}"
+        return f"{name}_{number}.zip", f"Глава: {job.folder_name}, часть {number}"
+
+
+pipeline = ChapterPipeline('iqtao', job_store, chapter_cache, active_downloads, output_folder, upload_concurrency, pipeline_buffer)
+
+
+def create_driver():
     chrome_options = Options()
     chrome_options.add_argument('--headless')
     chrome_options.add_argument('--no-sandbox')
     chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+    chrome_options.page_load_strategy = 'eager'
 
     driver = webdriver.Chrome(options=chrome_options)
-    driver.get(link)
-    scroll_to_bottom(driver)
-    title = driver.find_element(By.TAG_NAME, 'h1').text or 'название_не_найдено'
-    images = driver.find_elements(By.TAG_NAME, 'img')
+    if blocked_urls:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked_urls})
+    return driver
+
+
+def browser_memory(driver):
+    service = psutil.Process(driver.service.process.pid)
+    return sum(process.memory_info().rss for process in service.children(recursive=True))
+
+
+class DriverPool:
+    def __init__(self, size, max_pages, max_memory):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self.drivers = asyncio.Queue()
+        self.pages = {}
+
+    async def start(self):
+        for _ in range(self.size):
+            self.drivers.put_nowait(await self.relaunch(None))
+
+    async def close(self):
+        while not self.drivers.empty():
+            driver = self.drivers.get_nowait()
+            if driver is not None:
+                await asyncio.to_thread(self.quit, driver)
+
+    async def relaunch(self, driver):
+        if driver is not None:
+            await asyncio.to_thread(self.quit, driver)
+        try:
+            driver = await asyncio.to_thread(create_driver)
+        except Exception as e:
+            print(f"Не удалось запустить браузер: {e}")
+            return None
+        self.pages[driver] = 0
+        return driver
+
+    def quit(self, driver):
+        self.pages.pop(driver, None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
 
-    urls = []
-    for img in images:
-        src = img.get_attribute('src')
+    def is_healthy(self, driver):
+        try:
+            driver.execute_script('return 1')
+            return True
+        except Exception:
+            return False
+
+    def is_reusable(self, driver):
+        if self.pages.get(driver, 0) >= self.max_pages:
+            return False
+        try:
+            memory = browser_memory(driver)
+        except (psutil.Error, AttributeError):
+            return False
+        return memory < self.max_memory
+
+    @asynccontextmanager
+    async def acquire(self):
+        driver = await self.drivers.get()
+        try:
+            if driver is None or not await asyncio.to_thread(self.is_healthy, driver):
+                driver = await self.relaunch(driver)
+                if driver is None:
+                    raise RuntimeError("Браузер недоступен")
+            self.pages[driver] += 1
+            yield driver
+        finally:
+            if driver is not None and not await asyncio.to_thread(self.is_reusable, driver):
+                driver = await self.relaunch(driver)
+            self.drivers.put_nowait(driver)
+
+
+driver_pool = DriverPool(driver_pool_size, driver_max_pages, driver_max_memory)
 
-        if 'floatW' in src:
-            continue
 
-        if src in ['https://mh.iqtao.cn/images/loading_bak.png', '/images/loading_bak.png']:
-            src = img.get_attribute('data-src')
+def is_placeholder(src):
+    return not src or any(src.endswith(placeholder) for placeholder in placeholder_images)
+
+
+def page_urls(link, images):
+    urls = []
+    for src, data_src in images:
+        if is_placeholder(src):
+            src = data_src
 
         if src:
-            urls.append(src)
+            urls.append(urljoin(link, src))
+
+    return chapters.skip_pages(probe_rules, link, list(dict.fromkeys(urls)))
+
 
-    driver.quit()
+def parse_chapter_html(link, html):
+    soup = BeautifulSoup(html, 'html.parser')
+    title = soup.h1.get_text(strip=True) if soup.h1 else ''
 
-    return title, urls
+    urls = page_urls(link, [(img.get('src'), img.get('data-src')) for img in soup.find_all('img')])
 
+    if not urls:
+        scripts = '\n'.join(script.string or '' for script in soup.find_all('script'))
+        found = [url.replace('\\/', '/') for url in image_url_pattern.findall(scripts)]
+        urls = page_urls(link, [(url, None) for url in found])
 
-async def download_images(link, chapter_folder):
-    title, urls = await asyncio.to_thread(selenium_task, link)
+    return title or 'название_не_найдено', urls
 
-    os.makedirs(chapter_folder, exist_ok=True)
 
-    total = len(urls)
+async def fetch_chapter(link):
+    try:
+        timeout = aiohttp.ClientTimeout(total=20)
+        async with aiohttp.ClientSession(headers={'User-Agent': user_agent}, timeout=timeout) as session:
+            async with host_slot('render', link), session.get(link) as response:
+                if response.status != 200:
+                    print(f"Быстрый путь: страница вернула {response.status}")
+                    return None, []
+                html = await response.text(errors='replace')
+    except Exception as e:
+        print(f"Быстрый путь: не удалось получить страницу: {e}")
+        return None, []
+
+    return parse_chapter_html(link, html)
+
+
+def selenium_task(driver, link):
+    driver.get(link)
+    chapters.wait_for_images(driver, 'body', placeholder_images)
+    title = driver.find_element(By.TAG_NAME, 'h1').text or 'название_не_найдено'
+    images = [
+        (img.get_attribute('src'), img.get_attribute('data-src'))
+        for img in driver.find_elements(By.TAG_NAME, 'img')
+    ]
 
-    async with aiohttp.ClientSession() as session:
-        async def download_image(session, chapter_folder, url, idx):
+    return title, page_urls(link, images)
+
+
+async def render_chapter(link):
+    for attempt in range(2):
+        async with host_slot('render', link), driver_pool.acquire() as driver:
             try:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        async with aiofiles.open(os.path.join(chapter_folder, f'{idx}.jpg'), 'wb') as out_file:
-                            await out_file.write(await response.read())
-                    else:
-                        tqdm.write(f"Ошибка загрузки {idx + 1}: {response.status}")
-            except Exception as e:
-                tqdm.write(f"Ошибка загрузки {idx + 1}: {e}")
+                with metrics.timed_stage('render', link=link):
+                    return await asyncio.to_thread(selenium_task, driver, link)
+            except WebDriverException as e:
+                if attempt:
+                    raise
+                print(f"Браузер не ответил, повторяю с другим: {e}")
+
+
+async def collect_pages(link):
+    with metrics.timed_stage('extract', link=link) as fields:
+        title, urls = await fetch_chapter(link)
+        fields['pages'] = len(urls)
+    if urls:
+        print(f"Быстрый путь: найдено {len(urls)} страниц")
+    else:
+        print("Быстрый путь не нашёл страниц, открываю браузер")
+        title, urls = await render_chapter(link)
+    async with aiohttp.ClientSession(headers={'User-Agent': user_agent}) as session:
+        return title, await chapters.probe_pages(session, link, urls, probe_rules, lambda url: host_slot('fetch', url))
+
+
+def page_source(driver, link):
+    driver.get(link)
+    return driver.page_source
+
+
+async def fetch_series(link):
+    try:
+        timeout = aiohttp.ClientTimeout(total=20)
+        async with aiohttp.ClientSession(headers={'User-Agent': user_agent}, timeout=timeout) as session:
+            async with host_slot('render', link), session.get(link) as response:
+                response.raise_for_status()
+                found = chapters.series_chapters(link, await response.text(errors='replace'))
+        if found:
+            return found
+    except Exception as e:
+        print(f"Быстрый путь: не удалось получить оглавление: {e}")
+
+    async with host_slot('render', link), driver_pool.acquire() as driver:
+        return chapters.series_chapters(link, await asyncio.to_thread(page_source, driver, link))
+
+
+def page_extension():
+    if image_processing and image_processing.get('format') == 'WEBP':
+        return 'webp'
+    return 'jpg'
 
-        tasks = []
-        with tqdm(total=total, desc="Загрузка изображений", unit="изобр") as pbar:
-            for idx, url in enumerate(urls):
-                task = asyncio.create_task(download_image(session, chapter_folder, url, idx))
-                task.add_done_callback(lambda _: pbar.update(1))
-                tasks.append(task)
-            await asyncio.gather(*tasks)
 
-    return True
+async def download_image(session, url, idx):
+    page = tempfile.SpooledTemporaryFile(max_size=download_spool_size)
+    for attempt in range(download_retries):
+        offset = page.tell()
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            async with host_slot('fetch', url), session.get(url, headers=headers) as response:
+                if response.status in (200, 206):
+                    if response.status == 200 and offset:
+                        page.seek(0)
+                        page.truncate()
+                    async for chunk in response.content.iter_chunked(download_chunk_size):
+                        page.write(chunk)
+                        metrics.inc('download_bytes_total', len(chunk))
+                    page.seek(0)
+                    metrics.inc('download_pages_total', result='ok')
+                    return page
+                tqdm.write(f"Ошибка загрузки {idx + 1}: {response.status}, попытка {attempt + 1}")
+                if response.status == 416:
+                    page.seek(0)
+                    page.truncate()
+                elif response.status < 500 and response.status != 429:
+                    break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            tqdm.write(f"Ошибка загрузки {idx + 1}: {e!r}, попытка {attempt + 1}")
+        metrics.inc('download_retries_total')
+        await asyncio.sleep(0.5 * 2 ** attempt + random.random())
+    page.close()
+    metrics.inc('download_pages_total', result='failed')
+    return None
+
+
+async def download_images(job, archive_path):
+    if job.urls is None:
+        job.title, job.urls = await collect_pages(job.link)
+        job_store.set_urls(job.id, job.title, job.urls)
+    title, urls = job.title, job.urls
+
+    archive = chapters.ChapterArchive(
+        archive_path, page_extension(), job.pages, job.archive_size, job.archive_index,
+        lambda pages, size, index: job_store.checkpoint(job.id, pages, size, index),
+        [volume['pages'] for volume in job.volumes], archive_volume_bytes,
+        lambda path, pages: pipeline.seal_volume(job, path, pages), archive_checkpoint_pages,
+    )
+
+    pages = asyncio.Queue()
+    for idx, url in archive.remaining(urls):
+        pages.put_nowait((idx, url))
+    if archive.done:
+        print(f"Продолжаю главу {job.link}: уже скачано {len(archive.done)} из {len(urls)}")
+
+    try:
+        async with aiohttp.ClientSession(timeout=download_timeout) as session:
+            with metrics.timed_stage('download', job=job.id, pages=pages.qsize()), \
+                    tqdm(total=pages.qsize(), desc="Загрузка изображений", unit="изобр") as pbar:
+                async def fetch_pages():
+                    while not pages.empty():
+                        idx, url = pages.get_nowait()
+                        page = await download_image(session, url, idx)
+                        if page is None:
+                            archive.skip(idx)
+                        else:
+                            if image_processing:
+                                page = await imaging.process_file(page, **image_processing)
+                            archive.add(idx, page)
+                        pbar.update(1)
+
+                await asyncio.gather(*[fetch_pages() for _ in range(min(download_concurrency, pages.qsize()))])
+    finally:
+        archive.close()
+        metrics.record_stage('archive', archive.busy, job=job.id, pages=len(archive.done))
+
+    return chapters.ChapterResult(title, len(urls), sorted(archive.missing), sorted(archive.dropped))
 
 
 @dp.message(Command('start'))
 async def start(message: Message):
-    await message.answer("Привет! Отправь мне ссылку на главу, и я скачаю изображения с неё в виде архива.")
+    await message.answer(
+        "Привет! Отправь мне ссылку на главу, и я скачаю изображения с неё в виде архива.\n"
+        "Целый тайтл: /series <ссылка на страницу тайтла> [с-по]"
+    )
+
+
+@dp.message(Command('queue'))
+async def queue_status(message: Message):
+    if message.from_user.id not in allowed_users:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+
+    jobs = active_downloads.jobs.get(message.from_user.id)
+    if not jobs:
+        await message.answer("Ваших ссылок в очереди нет.")
+        return
+
+    lines = [
+        f"{active_downloads.position(job)}. {job.link} — {chapters.format_eta(active_downloads.eta(job))}"
+        for job in jobs
+    ]
+    await message.answer("Ваши ссылки в очереди:\n" + "\n".join(lines))
+
+
+@dp.message(Command('forget'))
+async def forget(message: Message, command: CommandObject):
+    if message.from_user.id not in allowed_users:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+
+    if not command.args:
+        await message.answer("Использование: /forget <ссылка> [название]")
+        return
+
+    parts = command.args.strip().split(" ", 1)
+    removed = chapter_cache.invalidate(parts[0], parts[1] if len(parts) > 1 else None)
+    await message.answer(f"Удалено из кэша: {removed}")
+
+
+@dp.message(Command('series'))
+async def series(message: Message, command: CommandObject):
+    if message.from_user.id not in allowed_users:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+
+    parts = (command.args or '').split()
+    if not parts or 'iqtao.cn' not in parts[0]:
+        await message.answer("Использование: /series <ссылка на страницу тайтла> [с-по], например: /series <ссылка> 1-20")
+        return
+
+    try:
+        found = await fetch_series(parts[0])
+    except Exception as e:
+        await message.answer(f"Не удалось открыть оглавление: {e}")
+        return
+    if not found:
+        await message.answer("Не нашёл глав на странице.")
+        return
+
+    selected = chapters.select_chapters(found, parts[1] if len(parts) > 1 else '')
+    if not selected:
+        await message.answer(f"Неверный диапазон. Всего глав: {len(found)}.")
+        return
+
+    selected = selected[:series_chapter_limit]
+    series_id = f"{message.chat.id}:{message.message_id}"
+    for series_index, (link, name) in enumerate(selected):
+        job = job_store.create(link, name or 'название_не_найдено', message, series_id, series_index)
+        pipeline.submit(job)
+    await message.answer(
+        f"В очередь добавлено глав: {len(selected)} из {len(found)}. Архивы придут по порядку, "
+        f"ожидание {chapters.format_eta(active_downloads.eta(job))}"
+    )
 
 
 @dp.message(F.text)
@@ -124,33 +472,93 @@ async def handle_message(message: Message):
         return
 
     print(f"Получена ссылка: {link}")
-    await active_downloads.put((link, folder_name, message))
-    await message.answer("Ссылка добавлена в очередь.")
+    entry = chapter_cache.get(link, folder_name)
+    if entry is not None:
+        if await pipeline.send_cached(message.chat.id, entry):
+            print(f"Глава {link} отправлена из кэша.")
+            return
+        chapter_cache.invalidate(link, folder_name)
+
+    job = pipeline.running(link, folder_name)
+    if job is not None:
+        if not await pipeline.join(job, message.chat.id):
+            await message.answer("Эта глава уже в очереди.")
+            return
+        position = active_downloads.position(job)
+        await message.answer(
+            "Эту главу уже скачивают по другому запросу, архив придёт и вам. "
+            + (f"Позиция: {position}" if position else "Загрузка уже идёт.")
+        )
+        return
+
+    job = job_store.create(link, folder_name, message)
+    pipeline.submit(job)
+    await message.answer(
+        f"Ссылка добавлена в очередь. Позиция: {active_downloads.position(job)}, "
+        f"ожидание {chapters.format_eta(active_downloads.eta(job))}"
+    )
 
 
-async def process_queue():
+async def render_worker(worker):
     while True:
-        link, folder_name, message = await active_downloads.get()
-        chapter_folder = os.path.join(output_folder, sanitize_folder_name(folder_name))
+        job = await active_downloads.get()
+        job.started = time.monotonic()
         try:
-            await message.answer(f"Скачиваю главу: {link if folder_name == 'название_не_найдено' else folder_name}")
+            job.cached = None if job.skip_cache else chapter_cache.get(job.link, job.folder_name)
+            if job.cached is None and job.urls is None:
+                if job.series is None:
+                    await job.answer(f"Скачиваю главу: {job.link if job.folder_name == 'название_не_найдено' else job.folder_name}")
+                job.title, job.urls = await collect_pages(job.link)
+                job_store.set_urls(job.id, job.title, job.urls)
+        except Exception as e:
+            print(f"[render {worker}] Ошибка при разборе главы {job.link}: {e}")
+            job.error = e
+        await pipeline.download_buffer.put(job)
+        metrics.set_gauge('pipeline_buffer', pipeline.download_buffer.qsize(), stage='download')
+
+
+async def download_worker(worker):
+    while True:
+        job = await pipeline.download_buffer.get()
+        if job.cached is None and job.error is None:
+            try:
+                job.result = await download_images(job, pipeline.archive_path(job))
+            except Exception as e:
+                print(f"[download {worker}] Ошибка при загрузке главы {job.link}: {e}")
+                job.error = e
+        await pipeline.upload_buffer.put(job)
+        metrics.set_gauge('pipeline_buffer', pipeline.upload_buffer.qsize(), stage='upload')
 
-            await download_images(link, chapter_folder)
 
-            archive_path = shutil.make_archive(chapter_folder, 'zip', chapter_folder)
-            file = types.FSInputFile(archive_path)
-            await message.answer_document(file, caption=f"Глава: {folder_name}")
-            print(f"Глава {link} успешно загружена.")
-        finally:
-            if os.path.exists(chapter_folder):
-                shutil.rmtree(chapter_folder)
-            if os.path.exists(f"{chapter_folder}.zip"):
-                os.remove(f"{chapter_folder}.zip")
+def start_workers():
+    return (
+        [asyncio.create_task(render_worker(worker)) for worker in range(driver_pool_size)]
+        + [asyncio.create_task(download_worker(worker)) for worker in range(worker_count)]
+        + [asyncio.create_task(pipeline.upload_worker())]
+    )
+
+
+async def resume_jobs():
+    for job in job_store.pending():
+        pipeline.submit(job)
+        print(f"Возвращаю в очередь главу {job.link}")
+        try:
+            await job.answer(f"Бот перезапущен, продолжаю загрузку: {job.link}")
+        except Exception as e:
+            print(f"Не удалось уведомить {job.chat_id}: {e}")
 
 
 async def main():
-    asyncio.create_task(process_queue())
-    await dp.start_polling(bot)
+    await metrics.start('iqtao', metrics_port)
+    await driver_pool.start()
+    await resume_jobs()
+    start_workers()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await driver_pool.close()
+        await metrics.stop()
+        imaging.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,131 @@
+import json
+import math
+import time
+import threading
+
+from contextlib import contextmanager
+
+from aiohttp import web
+
+service = None
+log_file = 'metrics.jsonl'
+buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+runner = None
+
+
+def series(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = series(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with lock:
+        gauges[series(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    key = series(name, labels)
+    with lock:
+        histogram = histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0, 'count': 0})
+        for idx, bound in enumerate(buckets):
+            if value <= bound:
+                histogram['buckets'][idx] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def log(event, **fields):
+    if not log_file:
+        return
+    record = {'ts': round(time.time(), 3), 'service': service, 'event': event, **fields}
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with lock, open(log_file, 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+
+
+def record_stage(stage, seconds, status='ok', **fields):
+    observe('stage_seconds', seconds, stage=stage)
+    log('stage', stage=stage, seconds=round(seconds, 3), status=status, **fields)
+
+
+@contextmanager
+def timed_stage(stage, **fields):
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield fields
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - started, status, **fields)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    lines = []
+    with lock:
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f'# TYPE {name} {kind}')
+                for (series_name, labels), value in sorted(values.items()):
+                    if series_name == name:
+                        lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (series_name, labels), histogram in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                for bound, count in zip(buckets + (math.inf,), histogram['buckets'] + [histogram['count']]):
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", format_value(bound)),))} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(histogram["sum"])}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start(name, port=None, host='127.0.0.1'):
+    global service, runner
+    service = name
+    if port is None or runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Метрики доступны на http://{host}:{port}/metrics")
+
+
+async def stop():
+    global runner
+    if runner is not None:
+        await runner.cleanup()
+        runner = None